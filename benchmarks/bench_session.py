@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List
+
+from constants import CLASSES, ERASE
+from parser.registry import NO_PARSER
+from utils.annotation_session import AnnotationSession
+from utils import instrumentation
+from utils.csv_reader import CSVReader
+from utils.csv_reader_wrapper import CSVReaderWrapperWithWeakEstimator
+
+PREFECTURES = ["東京都", "大阪府", "神奈川県", "愛知県", "北海道", "福岡県", "京都府", "兵庫県"]
+CITIES = ["横浜市", "名古屋市", "札幌市", "福岡市", "川崎市", "神戸市", "京都市", "さいたま市"]
+WARDS = ["中央区", "北区", "南区", "港区", "西区", "東区", "緑区", ""]
+VILLAGES = ["本町", "栄町", "旭町", "桜台", "若葉", "緑が丘", "大手町", "新町"]
+BUILDINGS = ["サンハイツ", "グランドメゾン", "パークタワー", "コーポ山田", "ライオンズマンション", ""]
+
+
+def _synthetic_record(rng: random.Random) -> Dict[str, str]:
+    record = {
+        "prefecture": rng.choice(PREFECTURES),
+        "city": rng.choice(CITIES),
+        "ward": rng.choice(WARDS),
+        "village": rng.choice(VILLAGES),
+        "chome": f"{rng.randint(1, 9)}丁目",
+        "block": f"{rng.randint(1, 30)}-{rng.randint(1, 20)}",
+        "building": rng.choice(BUILDINGS),
+    }
+    if record["building"]:
+        record["floor"] = f"{rng.randint(1, 20)}F"
+        record["unit"] = f"{rng.randint(1, 20)}0{rng.randint(1, 9)}号室"
+    return record
+
+
+def generate_input(path: str, num_records: int, seed: int = 0):
+    """
+    Write synthetic addresses with noisy predicted columns, as written by preannotate.py.
+    """
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write("\t".join(["sourceid", "address", *CLASSES]) + "\n")
+        for i in range(num_records):
+            record = _synthetic_record(rng)
+            address = "".join(record.get(label, "") for label in ["prefecture", "city", "ward", "village", "chome",
+                                                                  "block", "building", "floor", "unit"])
+            # Weak estimator makes mistakes
+            predicted = {label: value for label, value in record.items() if rng.random() > 0.1}
+            f.write("\t".join([str(i), address, *(predicted.get(label, "") for label in CLASSES)]) + "\n")
+
+
+def _percentiles(latencies: List[float]) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {f"p{p}": latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000 for p in (50, 90, 99)} \
+        | {"max": latencies[-1] * 1000}
+
+
+def replay(input_path: str, max_records: int, flush_every: int, trace_memory: bool, seed: int = 0,
+           parser_name: str = NO_PARSER) -> Dict:
+    """
+    Replay a scripted annotation trace: for each record, advance to it, apply a few label edits with occasional
+    undo, then commit.
+    """
+    rng = random.Random(seed)
+    output_dir = tempfile.mkdtemp(prefix="bench_session_")
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        data = CSVReaderWrapperWithWeakEstimator.from_file(path=input_path, sep="\t", parser_name=parser_name)
+        session = AnnotationSession(data, input_path=input_path, output_dir=output_dir, flush_every=flush_every)
+        session.open()
+        startup_seconds = time.perf_counter() - start
+
+        next_latencies, edit_latencies = [], []
+        num_records = min(max_records, len(session)) if max_records else len(session)
+        first_record_seconds = startup_seconds
+        for i in range(num_records):
+            t = time.perf_counter()
+            if i > 0:
+                session.commit()
+            # First record is shown without waiting for the parser, as the UI does
+            session.next_record(wait_estimator=i > 0)
+            next_latencies.append(time.perf_counter() - t)
+            if i == 0:
+                first_record_seconds = time.perf_counter() - start
+
+            address = session.address
+            for _ in range(rng.randint(1, 3)):
+                start_index = rng.randrange(len(address))
+                end_index = rng.randint(start_index + 1, min(start_index + 6, len(address)))
+                label = rng.choice(CLASSES + [ERASE])
+                t = time.perf_counter()
+                session.set_label(start_index, end_index, label)
+                if rng.random() < 0.1:
+                    session.undo()
+                edit_latencies.append(time.perf_counter() - t)
+        session.commit()
+        session.close()
+        total_seconds = time.perf_counter() - start
+
+        if trace_memory:
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            peak_memory = {"tracemalloc_peak_mb": peak_bytes / 2 ** 20}
+        else:
+            # ru_maxrss is in KB on Linux and bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak_memory = {"max_rss_mb": max_rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)}
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        shutil.rmtree(output_dir)
+
+    return {
+        "records": num_records,
+        "startup_ms": startup_seconds * 1000,
+        "first_record_ms": first_record_seconds * 1000,
+        "next_address_ms": _percentiles(next_latencies),
+        "edit_ms": _percentiles(edit_latencies),
+        "records_per_second": num_records / total_seconds,
+        **peak_memory,
+    }
+
+
+def measure_reader_memory(input_path: str) -> Dict[str, float]:
+    """
+    Compare Python heap held by CSVReader with rows as dicts and as a ColumnTable.
+    """
+    result = {}
+    for name, columnar in (("rows_mb", False), ("columnar_mb", True)):
+        tracemalloc.start()
+        try:
+            reader = CSVReader.from_file(input_path, sep="\t", columnar=columnar)
+            result[name] = tracemalloc.get_traced_memory()[0] / 2 ** 20
+            if columnar:
+                # Records must be safe for the wrapper to add predicted keys to
+                reader.read_record(0)["predicted"] = ""
+                result["records_are_copies"] = "predicted" not in reader.read_record(0)
+            del reader
+        finally:
+            tracemalloc.stop()
+    result["reduction"] = result["rows_mb"] / result["columnar_mb"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark headless annotation session with synthetic addresses.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Number of rows of synthetic input files")
+    parser.add_argument("--max_records", type=int, default=0,
+                        help="Replay only first N records of each file. 0 to replay all.")
+    parser.add_argument("--flush_every", type=int, default=1)
+    parser.add_argument("--data_dir", type=str, default=os.path.join(tempfile.gettempdir(), "address_annotator_bench"),
+                        help="Directory to keep generated input files")
+    parser.add_argument("--trace_memory", action="store_true",
+                        help="Measure peak Python heap with tracemalloc instead of max RSS. Slows down the replay.")
+    parser.add_argument("--parser", type=str, default=NO_PARSER,
+                        help="Parser to estimate labels (see parser.registry). Synthetic input has predicted columns.")
+    parser.add_argument("--reader_memory", action="store_true",
+                        help="Also compare memory of in-memory CSVReader with rows as dicts and as columns")
+    parser.add_argument("--min_memory_reduction", type=float, default=5.0,
+                        help="Fail if the columnar CSVReader doesn't cut memory by this factor")
+    parser.add_argument("--output_file", type=str, help="Write results as JSON")
+    parser.add_argument("--profile_output", type=str, help="Also write per-stage latency histograms (.json or .csv)")
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.profile_output is not None:
+        instrumentation.enable(args.profile_output)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {}
+    failed = False
+    for size in args.sizes:
+        input_path = os.path.join(args.data_dir, f"synthetic_{size}.tsv")
+        if not os.path.exists(input_path):
+            print(f"Generating {input_path}...")
+            generate_input(input_path, size)
+        result = replay(input_path, max_records=args.max_records, flush_every=args.flush_every,
+                        trace_memory=args.trace_memory, parser_name=args.parser)
+        if args.reader_memory:
+            result["reader_memory"] = measure_reader_memory(input_path)
+            if result["reader_memory"]["reduction"] < args.min_memory_reduction:
+                print(f"Columnar CSVReader cut memory of {size} rows only by "
+                      f"{result['reader_memory']['reduction']:.1f}x (< {args.min_memory_reduction}x).")
+                failed = True
+            if not result["reader_memory"]["records_are_copies"]:
+                print(f"Columnar CSVReader of {size} rows returns records shared between reads, so keys added by "
+                      f"the wrapper leak into later reads.")
+                failed = True
+        results[size] = result
+        print(f"{size} rows: {json.dumps(result)}")
+
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
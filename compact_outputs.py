@@ -0,0 +1,215 @@
+import argparse
+import csv
+import heapq
+from itertools import groupby, islice, zip_longest
+import json
+import os
+import shutil
+import sys
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from constants import CLASSES
+from utils.annotation_model import words_from_spans
+from utils.annotation_session import CHAR_LABEL_FILE_NAME, LABELLED_FILE_NAME, SPAN_LABEL_FILE_NAME
+from utils.char_label_reader import iter_char_label_records
+from utils.char_label_writer import CharLabelWriter
+from utils.checkpoint import CHECKPOINT_SUFFIX, SESSION_SUFFIX
+from utils.csv_writer import CSVWriter
+from utils.span_label_writer import SpanLabelWriter, labels_to_spans
+
+SOURCEID_INDEX_FILE_NAME = "sourceid_index.tsv"
+CONFLICT_FILE_NAME = "conflicts.jsonl"
+
+# (sourceid, session rank, record number, labelled row, char labels)
+Record = Tuple[str, int, int, Dict[str, str], List[str]]
+
+
+def _session_inputs(output_dir: str) -> Dict[str, str]:
+    # Input of each labelled file in the directory, by session manifests and checkpoints
+    inputs = {}
+    for name in sorted(os.listdir(output_dir)):
+        if not name.endswith(SESSION_SUFFIX) and not name.endswith(CHECKPOINT_SUFFIX):
+            continue
+        try:
+            with open(os.path.join(output_dir, name), "r") as f:
+                manifest = json.load(f)
+            inputs[os.path.basename(manifest["labelled_file"])] = os.path.realpath(manifest["input_file"])
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Skipped {name} which cannot be read: {e!r}")
+    return inputs
+
+
+def find_sessions(output_dir: str, input_path: Optional[str] = None) -> List[Tuple[str, str]]:
+    """
+    Return (labelled file, char label file) of sessions in the directory from the oldest to the latest.
+    With input_path, only sessions of the input are returned. Without it, sessions must not be of several inputs.
+    """
+    inputs = _session_inputs(output_dir)
+    input_path = os.path.realpath(input_path) if input_path is not None else None
+    sessions = []
+    for name in os.listdir(output_dir):
+        if not name.endswith("_" + LABELLED_FILE_NAME):
+            continue
+        if input_path is not None and inputs.get(name) != input_path:
+            print(f"Skipped {name} of " + (f"another input {inputs[name]}." if name in inputs else "an unknown input."))
+            continue
+        prefix = name[:-len(LABELLED_FILE_NAME)]
+        for char_label_name in (prefix + CHAR_LABEL_FILE_NAME, prefix + SPAN_LABEL_FILE_NAME):
+            if os.path.exists(os.path.join(output_dir, char_label_name)):
+                sessions.append((os.path.join(output_dir, name), os.path.join(output_dir, char_label_name)))
+                break
+        else:
+            print(f"Skipped {name} which has no char label file.")
+    session_inputs = {inputs[os.path.basename(labelled_path)] for labelled_path, _ in sessions
+                      if os.path.basename(labelled_path) in inputs}
+    assert len(session_inputs) <= 1, \
+        f"Sessions in {output_dir} are of several inputs {sorted(session_inputs)}. Choose one with --input_file."
+    # Time of the last write, since sessions can be resumed
+    sessions.sort(key=lambda paths: (os.path.getmtime(paths[0]), paths[0]))
+    return sessions
+
+
+def iter_session_records(labelled_path: str, char_label_path: str, classes: List[str] = CLASSES,
+                         mismatches: Optional[List[Dict]] = None) -> Iterator[Tuple[Dict[str, str], List[str]]]:
+    """
+    Yield (labelled row, char labels) of a session whose both files agree. A record whose segments differ from
+    its char labels is skipped, and records from where the addresses differ are all skipped since the files are
+    out of line. Skipped records are appended to mismatches.
+    """
+    mismatches = mismatches if mismatches is not None else []
+    session = os.path.basename(labelled_path)
+    with open(labelled_path, "r", newline="") as f:
+        rows = csv.DictReader(f, delimiter="\t")
+        char_label_records = iter_char_label_records(char_label_path)
+        num_records = 0
+        for row, char_label_record in zip_longest(rows, char_label_records):
+            if row is None or char_label_record is None:
+                # Either file has run out, and the record taken from the other one is counted as remaining
+                num_remaining_rows = (row is not None) + sum(1 for _ in rows)
+                num_remaining_labels = (char_label_record is not None) + sum(1 for _ in char_label_records)
+                mismatches.append({"session": session, "record": num_records + 1,
+                                   "error": f"{num_remaining_rows} rows of {labelled_path} and {num_remaining_labels} "
+                                            f"records of {char_label_path} have no counterpart and are skipped."})
+                return
+            num_records += 1
+            address, char_labels = char_label_record
+            if row["address"] != address:
+                num_skipped = 1 + sum(1 for _ in rows)
+                mismatches.append({"session": session, "record": num_records, "row": row, "address": address,
+                                   "error": f"Addresses differ in {char_label_path}. This and the following "
+                                            f"{num_skipped - 1} rows are skipped."})
+                return
+            words = words_from_spans(address, labels_to_spans(char_labels), classes)
+            if any(row[label] != words[label] for label in classes):
+                mismatches.append({"session": session, "record": num_records, "row": row, "char_labels": char_labels,
+                                   "error": f"Segments differ from char labels in {char_label_path}"})
+                continue
+            yield row, char_labels
+
+
+def _write_runs(sessions: List[Tuple[str, str]], tmp_dir: str, run_size: int, mismatches: List[Dict]) -> List[str]:
+    # Sorted runs of at most run_size records, so that memory usage does not depend on the number of records
+    run_paths = []
+    for rank, (labelled_path, char_label_path) in enumerate(sessions):
+        records = enumerate(iter_session_records(labelled_path, char_label_path, mismatches=mismatches))
+        while True:
+            run = [(row["sourceid"], rank, i, row, char_labels) for i, (row, char_labels) in islice(records, run_size)]
+            if not run:
+                break
+            run.sort(key=lambda record: record[:3])
+            run_path = os.path.join(tmp_dir, f"run{len(run_paths):05d}.jsonl")
+            with open(run_path, "w") as f:
+                for record in run:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            run_paths.append(run_path)
+    return run_paths
+
+
+def _iter_run(path: str) -> Iterator[Record]:
+    with open(path, "r") as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def compact(output_dir: str, compacted_dir: str, on_conflict: str = "latest", char_label_format: str = "text",
+            run_size: int = 100000, input_path: Optional[str] = None) -> Dict[str, int]:
+    """
+    Merge all sessions in output_dir, or those of input_path, into one labelled file and char label file ordered by sourceid, with an index
+    of byte offsets of each sourceid. When a sourceid is labelled differently in several sessions, the latest one
+    is kept, or with on_conflict="flag", all versions are written to the conflict file instead. Records whose
+    labelled file and char label file disagree are not compacted and are written to the conflict file.
+    """
+    assert on_conflict in ("latest", "flag"), f"Unknown conflict resolution: {on_conflict}"
+    sessions = find_sessions(output_dir, input_path=input_path)
+    assert sessions, f"No session output is found in {output_dir}!"
+    with open(sessions[0][0], "r", newline="") as f:
+        header = next(csv.reader(f, delimiter="\t"))
+
+    os.makedirs(compacted_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix="compact_", dir=compacted_dir)
+    stats = {"sessions": len(sessions), "records": 0, "sourceids": 0, "conflicts": 0, "mismatches": 0}
+    mismatches = []
+    char_label_file_name = SPAN_LABEL_FILE_NAME if char_label_format == "span" else CHAR_LABEL_FILE_NAME
+    char_label_writer_class = SpanLabelWriter if char_label_format == "span" else CharLabelWriter
+    try:
+        run_paths = _write_runs(sessions, tmp_dir, run_size, mismatches)
+        merged = heapq.merge(*(_iter_run(path) for path in run_paths), key=lambda record: record[:3])
+        with CSVWriter(os.path.join(compacted_dir, LABELLED_FILE_NAME), sep="\t", header=header,
+                       flush_every=1000) as writer, \
+                char_label_writer_class(os.path.join(compacted_dir, char_label_file_name),
+                                        flush_every=1000) as char_label_writer, \
+                open(os.path.join(compacted_dir, SOURCEID_INDEX_FILE_NAME), "w") as index_file, \
+                open(os.path.join(compacted_dir, CONFLICT_FILE_NAME), "w") as conflict_file:
+            index_file.write("sourceid\tlabelled_offset\tchar_label_offset\n")
+            for mismatch in mismatches:
+                print(f"{mismatch['session']} record {mismatch['record']}: {mismatch['error']}")
+                conflict_file.write(json.dumps({"mismatch": mismatch}, ensure_ascii=False) + "\n")
+            stats["mismatches"] = len(mismatches)
+            for sourceid, records in groupby(merged, key=lambda record: record[0]):
+                versions = list(records)
+                stats["records"] += len(versions)
+                _, _, _, row, char_labels = versions[-1]
+                if any((other_row, other_labels) != (row, char_labels) for _, _, _, other_row, other_labels in versions):
+                    stats["conflicts"] += 1
+                    if on_conflict == "flag":
+                        conflict_file.write(json.dumps({"sourceid": sourceid, "versions": [
+                            {"session": os.path.basename(sessions[rank][0]), "row": other_row,
+                             "char_labels": other_labels} for _, rank, _, other_row, other_labels in versions]},
+                            ensure_ascii=False) + "\n")
+                        continue
+                index_file.write(f"{sourceid}\t{writer.offset}\t{char_label_writer.offset}\n")
+                writer.append_dict(row)
+                char_label_writer.append(row["address"], char_labels)
+                stats["sourceids"] += 1
+    finally:
+        shutil.rmtree(tmp_dir)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact labelled files and char label files of all sessions "
+                                                 "in an output directory into one dataset ordered by sourceid.")
+    parser.add_argument("-d", "--output_dir", type=str, required=True, help="Output directory of annotator")
+    parser.add_argument("-i", "--input_file", type=str,
+                        help="Compact only sessions of this input. Required if the directory has several inputs.")
+    parser.add_argument("-o", "--compacted_dir", type=str, help="Default: compacted directory in the output directory")
+    parser.add_argument("--on_conflict", type=str, choices=["latest", "flag"], default="latest",
+                        help="Keep the latest labels of a sourceid labelled differently in several sessions, "
+                             "or write all of them to the conflict file without keeping any")
+    parser.add_argument("--char_label_format", type=str, choices=["text", "span"], default="text")
+    parser.add_argument("--run_size", type=int, default=100000,
+                        help="Number of records sorted in memory at a time")
+    args = parser.parse_args(sys.argv[1:])
+
+    compacted_dir = args.compacted_dir if args.compacted_dir is not None \
+        else os.path.join(args.output_dir, "compacted")
+    stats = compact(args.output_dir, compacted_dir, on_conflict=args.on_conflict,
+                    char_label_format=args.char_label_format, run_size=args.run_size, input_path=args.input_file)
+    print(f"Compacted {stats['records']} records of {stats['sessions']} sessions into {stats['sourceids']} records "
+          f"in {compacted_dir}. {stats['conflicts']} sourceids have conflicting labels. "
+          f"{stats['mismatches']} mismatches between labelled and char label files are skipped.")
+
+
+if __name__ == '__main__':
+    main()
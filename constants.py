@@ -2,6 +2,8 @@ from enum import Enum
 
 ERASE = "<ERASE>"
 
+CLASSES = ["prefecture", "city", "ward", "village", "chome", "block", "building", "unit", "floor"]
+
 
 class EnterMode(Enum):
     IDLE = 1
@@ -10,3 +12,8 @@ class EnterMode(Enum):
 
 
 CHAR_LABEL_SEPARATOR = "|"
+# Char label of characters which don't belong to any class
+OUTSIDE_LABEL = "o"
+# Char label of characters erased by ERASE
+ERASED_LABEL = ""
+SPAN_LABEL_FILE_EXTENSION = ".jsonl"
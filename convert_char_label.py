@@ -0,0 +1,53 @@
+import argparse
+import sys
+
+from constants import SPAN_LABEL_FILE_EXTENSION
+from utils.char_label_reader import CharLabelReader
+from utils.char_label_writer import CharLabelWriter
+from utils.compression import strip_compression_extension
+from utils.span_label_reader import SpanLabelReader
+from utils.span_label_writer import DEFAULT_LABELS, SpanLabelWriter
+
+
+def text_to_span(input_path: str, output_path: str):
+    # First pass to collect labels which are not in the default vocabulary
+    labels = list(DEFAULT_LABELS)
+    known_labels = set(labels)
+    for _, char_labels in CharLabelReader.iter_file(input_path):
+        for label in set(char_labels) - known_labels:
+            labels.append(label)
+            known_labels.add(label)
+
+    num_records = 0
+    with SpanLabelWriter(output_path, labels=labels, flush_every=1000) as writer:
+        for address, char_labels in CharLabelReader.iter_file(input_path):
+            writer.append(address, char_labels)
+            num_records += 1
+    return num_records
+
+
+def span_to_text(input_path: str, output_path: str):
+    num_records = 0
+    with CharLabelWriter(output_path, flush_every=1000) as writer:
+        for address, char_labels in SpanLabelReader(input_path):
+            writer.append(address, char_labels)
+            num_records += 1
+    return num_records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Convert char label file between text format and "
+                                                 f"span-based format ({SPAN_LABEL_FILE_EXTENSION}).")
+    parser.add_argument("-i", "--input_file", type=str, required=True)
+    parser.add_argument("-o", "--output_file", type=str, required=True)
+    args = parser.parse_args(sys.argv[1:])
+
+    if strip_compression_extension(args.input_file).endswith(SPAN_LABEL_FILE_EXTENSION):
+        num_records = span_to_text(args.input_file, args.output_file)
+    else:
+        num_records = text_to_span(args.input_file, args.output_file)
+    print(f"Converted {num_records} records from {args.input_file} to {args.output_file}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import argparse
+from collections import deque
+from itertools import chain, islice
+import json
+import multiprocessing
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("evaluate_parser.py requires numpy. Install it with: pip install numpy") from e
+
+from constants import CLASSES, ERASED_LABEL, OUTSIDE_LABEL
+from parser.registry import DEFAULT_PARSER, NO_PARSER, load_parser_class
+from utils.aligner import align_predictions
+from utils.char_label_reader import iter_char_label_records
+
+# Label id 0 is for characters without class, including erased ones
+NONE_ID = 0
+LABEL_DTYPE = "u1"
+
+# Parser of each worker process
+_parser = None
+
+
+def _init_worker(parser_name: str):
+    global _parser
+    _parser = load_parser_class(parser_name)()
+
+
+def _encode_batch(records: List[Tuple[str, List[str]]], label_to_id: Dict[str, int],
+                  invalid_records: List[Tuple[str, List[str]]]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    # Records with labels out of the classes are skipped, and added to invalid_records with the unknown labels
+    if not set(chain.from_iterable(labels for _, labels in records)) <= label_to_id.keys():
+        valid_records = []
+        for address, labels in records:
+            unknown_labels = set(labels) - label_to_id.keys()
+            if unknown_labels:
+                invalid_records.append((address, sorted(unknown_labels)))
+            else:
+                valid_records.append((address, labels))
+        records = valid_records
+    addresses = [address for address, _ in records]
+    lengths = np.fromiter(map(len, addresses), dtype=np.int64, count=len(addresses))
+    flat_labels = list(chain.from_iterable(labels for _, labels in records))
+    gold_ids = np.fromiter(map(label_to_id.__getitem__, flat_labels), dtype=LABEL_DTYPE, count=len(flat_labels))
+    return addresses, gold_ids, lengths
+
+
+def _spans_of_ids(ids: np.ndarray, starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Runs of the same label id within each record, except for NONE_ID
+    begins = np.ones(len(ids), dtype=bool)
+    begins[1:] = ids[1:] != ids[:-1]
+    begins[starts[starts < len(ids)]] = True
+    run_starts = np.flatnonzero(begins)
+    run_ends = np.append(run_starts[1:], len(ids))
+    run_labels = ids[run_starts]
+    labelled = run_labels != NONE_ID
+    return run_starts[labelled], run_ends[labelled], run_labels[labelled]
+
+
+def _span_keys(starts: np.ndarray, ends: np.ndarray, labels: np.ndarray, num_chars: int, num_labels: int) \
+        -> np.ndarray:
+    return (starts.astype(np.int64) * (num_chars + 1) + ends) * num_labels + labels
+
+
+def count_batch(addresses: List[str], gold_ids: np.ndarray, lengths: np.ndarray,
+                predictions: List[Optional[Dict[str, str]]], num_labels: int) -> Dict[str, np.ndarray]:
+    """
+    Count characters and spans of a batch whose predicted segment values are aligned onto the addresses.
+    Positions are in the concatenation of the addresses.
+    """
+    starts = np.cumsum(lengths) - lengths
+    span_starts, span_ends, span_labels = [], [], []
+    for address, start, prediction in zip(addresses, starts.tolist(), predictions):
+        if prediction is None:
+            continue
+        for span_start, span_end, label in align_predictions(address, prediction, CLASSES):
+            span_starts.append(start + span_start)
+            span_ends.append(start + span_end)
+            span_labels.append(CLASSES.index(label) + 1)
+    span_starts = np.array(span_starts, dtype=np.int64)
+    span_ends = np.array(span_ends, dtype=np.int64)
+    span_labels = np.array(span_labels, dtype=np.int64)
+
+    # Spans don't overlap, so the cumulative sum of label changes at span boundaries gives char labels
+    num_chars = len(gold_ids)
+    changes = np.zeros(num_chars + 1, dtype=np.int64)
+    np.add.at(changes, span_starts, span_labels)
+    np.add.at(changes, span_ends, -span_labels)
+    predicted_ids = np.cumsum(changes[:-1])
+    gold = gold_ids.astype(np.int64)
+
+    confusion = np.bincount(gold * num_labels + predicted_ids, minlength=num_labels ** 2)
+    mismatches = np.concatenate(([0], np.cumsum(gold != predicted_ids)))
+    exact = (mismatches[starts + lengths] - mismatches[starts]) == 0
+
+    gold_keys = _span_keys(*_spans_of_ids(gold_ids, starts), num_chars, num_labels)
+    predicted_keys = _span_keys(span_starts, span_ends, span_labels, num_chars, num_labels)
+    correct_keys = np.intersect1d(gold_keys, predicted_keys, assume_unique=True)
+    return {
+        "records": np.array(len(addresses)),
+        "exact_match": np.array(int(exact.sum())),
+        "parse_errors": np.array(sum(prediction is None for prediction in predictions)),
+        "char_confusion": confusion.reshape(num_labels, num_labels),
+        "gold_spans": np.bincount(gold_keys % num_labels, minlength=num_labels),
+        "predicted_spans": np.bincount(predicted_keys % num_labels, minlength=num_labels),
+        "correct_spans": np.bincount(correct_keys % num_labels, minlength=num_labels),
+    }
+
+
+def evaluate_batch(addresses: List[str], gold_ids: np.ndarray, lengths: np.ndarray, num_labels: int) \
+        -> Dict[str, np.ndarray]:
+    predictions = []
+    for address in addresses:
+        try:
+            predictions.append({k.lower(): v for k, v in _parser.parse(address).items()})
+        except Exception:
+            predictions.append(None)
+    return count_batch(addresses, gold_ids, lengths, predictions, num_labels)
+
+
+def _f1(correct: float, predicted: float, gold: float) -> Dict[str, float]:
+    precision = correct / predicted if predicted else 0.0
+    recall = correct / gold if gold else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1, "support": int(gold)}
+
+
+def make_report(counts: Dict[str, np.ndarray]) -> Dict:
+    confusion = counts["char_confusion"]
+    report = {
+        "records": int(counts["records"]),
+        "exact_match": int(counts["exact_match"]) / max(int(counts["records"]), 1),
+        "parse_errors": int(counts["parse_errors"]),
+        "char": {},
+        "span": {},
+    }
+    for i, label in enumerate(CLASSES, start=1):
+        report["char"][label] = _f1(confusion[i, i], confusion[:, i].sum(), confusion[i, :].sum())
+        report["span"][label] = _f1(counts["correct_spans"][i], counts["predicted_spans"][i], counts["gold_spans"][i])
+    classes = slice(1, None)
+    report["char"]["micro"] = _f1(np.trace(confusion[classes, classes]), confusion[:, classes].sum(),
+                                  confusion[classes, :].sum())
+    report["span"]["micro"] = _f1(counts["correct_spans"][classes].sum(), counts["predicted_spans"][classes].sum(),
+                                  counts["gold_spans"][classes].sum())
+    return report
+
+
+def _iter_batches(records: Iterator[Tuple[str, List[str]]], batch_size: int) -> Iterator[List[Tuple[str, List[str]]]]:
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def evaluate(input_path: str, parser_name: str, num_workers: int, batch_size: int = 1000,
+             max_records: int = 0) -> Dict:
+    """
+    Run the parser on addresses of a char label file (text or span format) in a process pool, and compare the
+    predictions aligned onto the addresses against the char labels.
+    """
+    label_to_id = {label: i for i, label in enumerate(CLASSES, start=1)}
+    label_to_id[OUTSIDE_LABEL] = label_to_id[ERASED_LABEL] = NONE_ID
+    num_labels = len(CLASSES) + 1
+    records = iter_char_label_records(input_path)
+    if max_records:
+        records = islice(records, max_records)
+    invalid_records = []
+    batches = (_encode_batch(batch, label_to_id, invalid_records) for batch in _iter_batches(records, batch_size))
+
+    counts = count_batch([], np.empty(0, dtype=LABEL_DTYPE), np.empty(0, dtype=np.int64), [], num_labels)
+
+    def add(batch_counts: Dict[str, np.ndarray]):
+        for key, value in batch_counts.items():
+            counts[key] = counts[key] + value
+
+    # The parser is built here first, since a pool endlessly respawns workers whose initializer fails
+    global _parser
+    try:
+        _parser = load_parser_class(parser_name)()
+    except Exception as e:
+        raise RuntimeError(f"Parser {parser_name} cannot be loaded: {e!r}") from e
+
+    start = time.perf_counter()
+    if num_workers == 0:
+        for batch in batches:
+            add(evaluate_batch(*batch, num_labels))
+    else:
+        with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(parser_name,)) as pool:
+            # Batches are read only as fast as they are evaluated
+            pending = deque()
+            for batch in batches:
+                if len(pending) >= 2 * num_workers:
+                    add(pending.popleft().get())
+                pending.append(pool.apply_async(evaluate_batch, (*batch, num_labels)))
+            while pending:
+                add(pending.popleft().get())
+    seconds = time.perf_counter() - start
+
+    report = make_report(counts)
+    report["invalid_records"] = len(invalid_records)
+    if invalid_records:
+        print(f"{len(invalid_records)} records have labels out of the classes {CLASSES} and are not evaluated, "
+              f"e.g. {invalid_records[0][1]} in {invalid_records[0][0]}")
+    report["parser"] = parser_name
+    report["seconds"] = seconds
+    report["records_per_second"] = report["records"] / seconds if seconds else 0.0
+    return report
+
+
+def _print_report(report: Dict):
+    print(f"{report['records']} records in {report['seconds']:.1f}s ({report['records_per_second']:.0f} records/s), "
+          f"exact match {report['exact_match']:.4f}, parse errors {report['parse_errors']}, "
+          f"invalid records {report['invalid_records']}")
+    print(f"{'class':<12}{'char P':>8}{'char R':>8}{'char F1':>8}{'span P':>8}{'span R':>8}{'span F1':>8}"
+          f"{'support':>9}")
+    for label in [*CLASSES, "micro"]:
+        char, span = report["char"][label], report["span"][label]
+        print(f"{label:<12}{char['precision']:>8.4f}{char['recall']:>8.4f}{char['f1']:>8.4f}"
+              f"{span['precision']:>8.4f}{span['recall']:>8.4f}{span['f1']:>8.4f}{span['support']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a parser against labelled char label files. Predicted "
+                                                 "segments are aligned onto addresses and compared per character "
+                                                 "and per span.")
+    parser.add_argument("-i", "--input_file", type=str, required=True, help="Char label file (text or span format)")
+    parser.add_argument("--parser", type=str, default=DEFAULT_PARSER,
+                        help="Registered parser name or module.path:ClassName (see parser.registry)")
+    parser.add_argument("--num_workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of parser processes. 0 to parse in this process.")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--max_records", type=int, default=0, help="Evaluate only first N records. 0 for all.")
+    parser.add_argument("-o", "--output_file", type=str, help="Write the report as JSON")
+    args = parser.parse_args(sys.argv[1:])
+    assert args.parser != NO_PARSER, "Parser is required for evaluation."
+
+    try:
+        report = evaluate(args.input_file, args.parser, num_workers=args.num_workers, batch_size=args.batch_size,
+                          max_records=args.max_records)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    _print_report(report)
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
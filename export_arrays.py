@@ -0,0 +1,149 @@
+import argparse
+from itertools import chain, islice
+import json
+import os
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("export_arrays.py requires numpy. Install it with: pip install numpy") from e
+
+from constants import ERASED_LABEL, OUTSIDE_LABEL
+from utils.char_label_reader import iter_char_label_records
+from utils.span_label_writer import DEFAULT_LABELS
+
+CHARS_FILE_NAME = "chars.bin"
+LABELS_FILE_NAME = "labels.bin"
+OFFSETS_FILE_NAME = "offsets.bin"
+META_FILE_NAME = "meta.json"
+BIO_FILE_NAME = "bio.jsonl"
+# Characters are stored as unicode code points
+CHAR_DTYPE = "<u4"
+LABEL_DTYPE = "u1"
+OFFSET_DTYPE = "<i8"
+# Labels tagged as O in BIO tags
+UNLABELLED = (OUTSIDE_LABEL, ERASED_LABEL)
+
+
+def load_arrays(export_dir: str) -> Dict[str, np.ndarray]:
+    """
+    Memory-map exported arrays. Characters and labels of the i-th record are chars[offsets[i]:offsets[i + 1]] and
+    labels[offsets[i]:offsets[i + 1]], and label ids are indices of meta["labels"].
+    """
+    with open(os.path.join(export_dir, META_FILE_NAME), "r") as f:
+        meta = json.load(f)
+    arrays = {"offsets": np.memmap(os.path.join(export_dir, OFFSETS_FILE_NAME), dtype=OFFSET_DTYPE, mode="r")}
+    # Empty file cannot be memory-mapped
+    for name, file_name, dtype in (("chars", CHARS_FILE_NAME, CHAR_DTYPE), ("labels", LABELS_FILE_NAME, LABEL_DTYPE)):
+        path = os.path.join(export_dir, file_name)
+        arrays[name] = np.memmap(path, dtype=dtype, mode="r") if meta["num_chars"] > 0 else np.empty(0, dtype=dtype)
+    return arrays
+
+
+class ArrayExporter:
+    """
+    Encodes batches of char label records to arrays of character code points and label ids, and appends them to
+    files which are memory-mapped by load_arrays.
+    """
+
+    def __init__(self, export_dir: str, labels: Optional[List[str]] = None, bio: bool = False):
+        os.makedirs(export_dir, exist_ok=True)
+        self._export_dir = export_dir
+        self.labels = list(labels if labels is not None else DEFAULT_LABELS)
+        self._label_to_id = {label: i for i, label in enumerate(self.labels)}
+
+        self._chars_file = open(os.path.join(export_dir, CHARS_FILE_NAME), "wb")
+        self._labels_file = open(os.path.join(export_dir, LABELS_FILE_NAME), "wb")
+        self._offsets_file = open(os.path.join(export_dir, OFFSETS_FILE_NAME), "wb")
+        self._bio_file = open(os.path.join(export_dir, BIO_FILE_NAME), "w") if bio else None
+        np.zeros(1, dtype=OFFSET_DTYPE).tofile(self._offsets_file)
+
+        self.num_records = 0
+        self.num_chars = 0
+
+    def append_batch(self, records: List[Tuple[str, List[str]]]):
+        addresses = [address for address, _ in records]
+        chars = np.frombuffer("".join(addresses).encode("utf-32-le"), dtype=CHAR_DTYPE)
+        lengths = np.fromiter(map(len, addresses), dtype=OFFSET_DTYPE, count=len(addresses))
+
+        flat_labels = list(chain.from_iterable(labels for _, labels in records))
+        assert len(flat_labels) == len(chars), "Address and char label length should be the same!"
+        for label in set(flat_labels) - self._label_to_id.keys():
+            self._add_label(label)
+        label_ids = np.fromiter(map(self._label_to_id.__getitem__, flat_labels), dtype=LABEL_DTYPE,
+                                count=len(flat_labels))
+
+        chars.tofile(self._chars_file)
+        label_ids.tofile(self._labels_file)
+        (self.num_chars + np.cumsum(lengths)).tofile(self._offsets_file)
+        if self._bio_file is not None:
+            self._write_bio(addresses, label_ids, lengths)
+        self.num_records += len(records)
+        self.num_chars += len(chars)
+
+    def _add_label(self, label: str):
+        assert len(self.labels) <= np.iinfo(LABEL_DTYPE).max, f"Too many labels to export: {self.labels}"
+        self._label_to_id[label] = len(self.labels)
+        self.labels.append(label)
+
+    def _write_bio(self, addresses: List[str], label_ids: np.ndarray, lengths: np.ndarray):
+        # A tag begins where the label changes or a record starts
+        begins = np.ones(len(label_ids), dtype=bool)
+        begins[1:] = label_ids[1:] != label_ids[:-1]
+        starts = np.cumsum(lengths) - lengths
+        begins[starts[lengths > 0]] = True
+        b_tags = np.array([f"B-{label}" if label not in UNLABELLED else "O" for label in self.labels], dtype=object)
+        i_tags = np.array([f"I-{label}" if label not in UNLABELLED else "O" for label in self.labels], dtype=object)
+        tags = np.where(begins, b_tags[label_ids], i_tags[label_ids]).tolist()
+        for address, start, length in zip(addresses, starts.tolist(), lengths.tolist()):
+            self._bio_file.write(json.dumps({"address": address, "tags": tags[start:start + length]},
+                                            ensure_ascii=False) + "\n")
+
+    def close(self):
+        for f in (self._chars_file, self._labels_file, self._offsets_file, self._bio_file):
+            if f is not None:
+                f.close()
+        with open(os.path.join(self._export_dir, META_FILE_NAME), "w") as f:
+            json.dump({"num_records": self.num_records, "num_chars": self.num_chars, "labels": self.labels,
+                       "dtypes": {"chars": CHAR_DTYPE, "labels": LABEL_DTYPE, "offsets": OFFSET_DTYPE}},
+                      f, ensure_ascii=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _iter_batches(records: Iterator[Tuple[str, List[str]]], batch_size: int) -> Iterator[List[Tuple[str, List[str]]]]:
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def export(input_path: str, export_dir: str, bio: bool = False, batch_size: int = 10000) -> int:
+    with ArrayExporter(export_dir, bio=bio) as exporter:
+        for batch in _iter_batches(iter_char_label_records(input_path), batch_size):
+            exporter.append_batch(batch)
+    return exporter.num_records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export char label file to memory-mapped arrays of character code "
+                                                 "points, label ids and record offsets for training.")
+    parser.add_argument("-i", "--input_file", type=str, required=True, help="Char label file (text or span format)")
+    parser.add_argument("-o", "--export_dir", type=str, required=True)
+    parser.add_argument("--bio", action="store_true", help="Also write BIO-tagged JSON lines")
+    parser.add_argument("--batch_size", type=int, default=10000)
+    args = parser.parse_args(sys.argv[1:])
+
+    num_records = export(args.input_file, args.export_dir, bio=args.bio, batch_size=args.batch_size)
+    print(f"Exported {num_records} records from {args.input_file} to {args.export_dir}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,26 @@
 import argparse
-import datetime
 from enum import Enum
 import os
 import sys
+import time
 import tkinter as tk
 from tkinter import ttk
 import urllib.parse
 import webbrowser
 
-from constants import EnterMode, ERASE
-from utils.csv_reader import CSVReader
+from constants import CLASSES, EnterMode, ERASE
+from parser.registry import DEFAULT_PARSER, NO_PARSER, PARSERS
+from utils.annotation_session import AnnotationSession
 from utils.csv_reader_wrapper import CSVReaderWrapperWithWeakEstimator
-from utils.char_label_reader import CharLabelReader
-from utils.char_label_writer import CharLabelWriter
-from utils.csv_writer import CSVWriter
 from utils.decorator import mode
+from utils import instrumentation
+from utils.instrumentation import timed
+from utils.shard_leases import LeaseLostError, ShardLeases
 
 NUM_CHAR_PREVIEW_WIDGET = 4
 NUM_ROWS_IN_CHAR_PREVIEW_WIDGET = 15
-LABELLED_FILE_NAME = "labelled.txt"
-CHAR_LABEL_FILE_NAME = "char_label.txt"
+CHAR_PREVIEW_PAGE_SIZE = NUM_CHAR_PREVIEW_WIDGET * NUM_ROWS_IN_CHAR_PREVIEW_WIDGET
+PARSE_CACHE_FILE_NAME = "parse_cache.sqlite"
 
 
 class Token:
@@ -36,29 +37,44 @@ class Token:
 
 class AnnotatorApp:
 
-    def __init__(self, input_path, output_dir):
+    def __init__(self, input_path, output_dir, prefetch_window=0, prefetch_workers=1, preannotated=False,
+                 parse_cache_path=None, parse_cache_size=1000000, flush_every=1, flush_interval=None, fsync=False,
+                 char_label_format="text", group_duplicates=False, queue_block_size=None, auto_accept=None,
+                 shard_size=None, lease_seconds=600, parser_name=DEFAULT_PARSER, estimator_timeout=None):
+        self._start_time = time.perf_counter()
         self.root = None
-        self._input_path = input_path
-        self._output_dir = output_dir
+        self._classes = CLASSES
+        self._flush_interval = flush_interval
+        self._lease_seconds = lease_seconds
 
         # Prepare data
-        self._data = CSVReaderWrapperWithWeakEstimator.from_file(path=input_path, sep="\t")
-        assert "address" in self._data.get_header(), f"CSV file should have columns 'address'!"
-        self._classes = ["prefecture", "city", "ward", "village", "chome", "block", "building", "unit", "floor"]
-
-        # Output Files
-        datetime_id = datetime.datetime.now().isoformat().replace(":", ".")
-        self._output_path = os.path.join(output_dir, f"{datetime_id}_{LABELLED_FILE_NAME}")
-        self._writer = CSVWriter(path=self._output_path, sep="\t", header=["sourceid", "address", *self._classes])
-        self._char_label_output_path = os.path.join(output_dir, f"{datetime_id}_{CHAR_LABEL_FILE_NAME}")
-        self._char_label_writer = CharLabelWriter(path=self._char_label_output_path)
-
-        self._address = None
-        self._address_index = -1
+        data = CSVReaderWrapperWithWeakEstimator.from_file(path=input_path, sep="\t",
+                                                           prefetch_window=prefetch_window,
+                                                           prefetch_workers=prefetch_workers,
+                                                           parser_name=NO_PARSER if preannotated else parser_name,
+                                                           parse_cache_path=parse_cache_path,
+                                                           parse_cache_size=parse_cache_size,
+                                                           estimator_timeout=estimator_timeout)
+        self._data = data
+        leases = None
+        if shard_size is not None:
+            leases = ShardLeases.open(ShardLeases.path_for(output_dir, input_path), num_rows=len(data),
+                                      shard_size=shard_size, lease_seconds=lease_seconds)
+        self._session = AnnotationSession(data, input_path=input_path, output_dir=output_dir, classes=self._classes,
+                                          flush_every=flush_every, flush_interval=flush_interval, fsync=fsync,
+                                          char_label_format=char_label_format, group_duplicates=group_duplicates,
+                                          queue_block_size=queue_block_size, auto_accept=auto_accept, leases=leases)
 
         self._refresh()
 
     def start(self, resume: bool = False):
+        # Start from previous attempt
+        self._session.open(resume)
+        if not self._session.has_next():
+            print("All records are already labelled.")
+            self.close()
+            return
+
         self._init_root()
 
         style = ttk.Style()
@@ -74,44 +90,73 @@ class AnnotatorApp:
         self._init_label_preview_widget()
         self._init_clear_widget()
 
-        # Get first address
-        self._next_address(write_to_file=False)
-
-        # Start from previous attempt
-        if resume:
-            self._resume()
+        # Get first address. The parser may be still loading, and labels are estimated when it is ready.
+        self._next_address(write_to_file=False, wait_estimator=False)
+        self.root.after_idle(self._report_first_window)
+        self._wait_for_estimator()
 
         # Start UI
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            self.close()
 
-    def _resume(self):
-        # Get latest path
-        all_paths = os.listdir(self._output_dir)
-        latest_labelled_path = os.path.join(self._output_dir, sorted((p for p in all_paths if p.endswith("_" + LABELLED_FILE_NAME)))[-2])
-        latest_char_label_path = os.path.join(self._output_dir, sorted((p for p in all_paths if p.endswith("_" + CHAR_LABEL_FILE_NAME)))[-2])
+    def close(self):
+        self._session.close()
 
-        resume_labelled_data = CSVReader.from_file(path=latest_labelled_path, sep="\t")
-        print(f"Read labelled data from {latest_labelled_path}.")
-        resume_char_label_data = CharLabelReader.from_file(path=latest_char_label_path)
-        print(f"Read char-wise label data from {latest_char_label_path}.")
-        for i in range(len(resume_labelled_data)):
-            labelled_record = resume_labelled_data.read_record(i)
-            assert self._address == labelled_record["address"], \
-                f"Address in resume record should be same as current input!\n  Expected: {self._address}\n  Actual: {labelled_record['address']}"
+    def _on_close_window(self):
+        self.close()
+        self.root.destroy()
 
-            address, char_labels = resume_char_label_data.read_record(i)
-            assert self._address == address, \
-                f"Address in resume record should be same as current input!\n  Expected: {self._address}\n  Actual: {address}"
+    def _periodic_flush(self):
+        # Time-based flush also when no new record is appended
+        try:
+            self._session.flush()
+        except LeaseLostError as e:
+            self._on_lease_lost(e)
+            return
+        self.root.after(int(self._flush_interval * 1000), self._periodic_flush)
 
-            self._writer.append_dict(labelled_record)
-            self._char_label_writer.append(address, char_labels)
+    def _report_first_window(self):
+        elapsed = time.perf_counter() - self._start_time
+        instrumentation.record("first_window", int(elapsed * 1e9))
+        print(f"First window is shown in {elapsed * 1000:.0f} ms.")
+
+    def _wait_for_estimator(self):
+        if not self._data.estimator_ready():
+            self.root.after(100, self._wait_for_estimator)
+            return
+        load_seconds = self._data.estimator_load_seconds()
+        if load_seconds is not None:
+            print(f"Parser is loaded in {load_seconds * 1000:.0f} ms.")
+        if self._session.refresh_estimate():
+            self._update_preview()
+
+    def _periodic_heartbeat(self):
+        # Keep the lease of the shard while the annotator is idle
+        try:
+            self._session.heartbeat()
+        except LeaseLostError as e:
+            self._on_lease_lost(e)
+            return
+        self.root.after(int(self._lease_seconds * 1000 / 4), self._periodic_heartbeat)
 
-            self._next_address(write_to_file=False, estimate=False)
+    def _on_lease_lost(self, error: LeaseLostError):
+        print(f"{error} Restart the annotator to continue with another shard.")
+        self.address_title_string_var.set("Shard is taken by another annotator. Restart to continue.")
+        self.address_set_button.configure(state=tk.DISABLED)
 
     def _init_root(self):
         self.root = tk.Tk()
         self.root.geometry()
         self.root.title("AddressAnnotator")
+        self.root.protocol("WM_DELETE_WINDOW", self._on_close_window)
+        self.root.bind("<Control-z>", self._callback_undo)
+        self.root.bind("<Control-y>", self._callback_redo)
+        self.root.bind("<Control-Z>", self._callback_redo)
+        if self._flush_interval is not None:
+            self.root.after(int(self._flush_interval * 1000), self._periodic_flush)
+        self.root.after(int(self._lease_seconds * 1000 / 4), self._periodic_heartbeat)
 
     def _init_frames(self):
         self._top_frame = tk.Frame(self.root)
@@ -149,7 +194,7 @@ class AnnotatorApp:
                                             fg="Blue",
                                             anchor="w")
         self.address_link_widget.bind("<Button-1>", lambda e: webbrowser.open_new(
-            f"https://www.google.co.jp/maps/search/{urllib.parse.quote(self._address)}"))
+            f"https://www.google.co.jp/maps/search/{urllib.parse.quote(self._session.address)}"))
 
         self.address_title.grid(row=0, column=0, sticky=tk.W)
         self.address_text_widget.grid(row=1, column=0)
@@ -172,44 +217,32 @@ class AnnotatorApp:
                                             font=("Helvetica", 16))
         self.address_set_button.grid(row=1, column=1)
 
-    def _next_address(self, write_to_file=True, estimate=True):
+    @timed("ui_next_address")
+    def _next_address(self, write_to_file=True, estimate=True, wait_estimator=True):
         # Write previous record if exists
         if write_to_file:
-            # Write to CSV
-            self._label_to_words["address"] = self._address
-            self._label_to_words["sourceid"] = self._sourceid
-            self._writer.append_dict(self._label_to_words)
-
-            # Write to char-label txt file
-            self._char_label_writer.append(self._address,
-                                           [self._index_to_label.get(i, "o")
-                                            for i in range(len(self._address))])
-
-        self._refresh()
+            try:
+                self._session.commit()
+            except LeaseLostError as e:
+                self._on_lease_lost(e)
+                return
+
+        if not self._session.has_next():
+            self.address_title_string_var.set(f"All {len(self._session)} addresses are labelled")
+            self.address_set_button.configure(state=tk.DISABLED)
+            self._session.flush()
+            return
 
         # Read new address
-        self._address_index += 1
-        record = self._data.read_record(self._address_index, estimate=estimate)
-        self._address = record["address"]
-        self._sourceid = record["sourceid"]
-
-        # Fill in pre-defined label
-        found_index = set()
-        for label in self._classes:
-            if label in record:
-                value = record[label]
-                first_index = self._address.find(value)
-                if first_index in found_index:
-                    first_index = self._address[first_index+1:].find(value) + first_index + 1
-                if first_index >= 0:
-                    self._update(label, Token(value, first_index, first_index + len(value)))
-                    found_index.add(first_index)
+        self._session.next_record(estimate=estimate, wait_estimator=wait_estimator)
+        self._refresh()
 
         # Update address text
-        self.address_title_string_var.set(f"Input Address ({self._address_index + 1} / {len(self._data)})")
+        self.address_title_string_var.set(f"Input Address ({self._session.index + 1} / {len(self._session)})")
         self.address_text_widget.delete(1.0, "end")
-        self.address_text_widget.insert(1.0, self._address)
+        self.address_text_widget.insert(1.0, self._session.address)
 
+        self._char_preview_page = 0
         self._update_preview()
 
     def _init_select_label_menu(self):
@@ -244,21 +277,15 @@ class AnnotatorApp:
             self._update(label, self._selected_token)
         return _set_label
 
+    @timed("ui_update")
     def _update(self, label: str, token: Token):
-        # Update char-wise label
-        for i in range(token.first_index, token.last_index):
-            if label == ERASE:
-                self._index_to_label[i] = ""
-            else:
-                for i in range(token.first_index, token.last_index):
-                    self._index_to_label[i] = label
-        # Construct words based on char-wise label
-        self._label_to_words = {label: "" for label in self._classes}
-        for i, char in enumerate(self._address):
-            label = self._index_to_label.get(i, "")
-            if label in self._label_to_words:
-                self._label_to_words[label] += char
-        self._update_preview()
+        self._update_preview(*self._session.set_label(token.first_index, token.last_index, label))
+
+    def _callback_undo(self, event=None):
+        self._update_preview(*self._session.undo())
+
+    def _callback_redo(self, event=None):
+        self._update_preview(*self._session.redo())
 
     def _init_dict_preview_widgets(self):
         self.dict_preview_title = tk.Label(self._middle_frame,
@@ -277,14 +304,16 @@ class AnnotatorApp:
             self._dict_preview_widgets.heading(label, text=label, anchor="w")
         self._dict_preview_widgets.pack(anchor=tk.W)
 
-    def _update_dict_label_preview(self):
-        # Refresh
-        for i in self._dict_preview_widgets.get_children():
-            self._dict_preview_widgets.delete(i)
+        # The row is inserted once and only its values are updated
+        self._rendered_words = tuple("" for _ in self._classes)
+        self._dict_preview_widgets.insert(parent="", index=0, iid=0, values=self._rendered_words)
 
-        # Insert
-        self._dict_preview_widgets.insert(parent="", index=0, iid=0,
-                                          values=[self._label_to_words[label] for label in self._classes])
+    def _update_dict_label_preview(self):
+        label_to_words = self._session.annotation.words()
+        words = tuple(label_to_words[label] for label in self._classes)
+        if words != self._rendered_words:
+            self._dict_preview_widgets.item(0, values=words)
+            self._rendered_words = words
 
     def _init_label_preview_widget(self):
         self.label_preview_title = tk.Label(self._bottom_left_frame,
@@ -310,26 +339,60 @@ class AnnotatorApp:
 
             _preview_widget.grid(row=1, column=i)
 
-    def _update_label_preview(self):
-        # Refresh
-        for _preview_widget in self._label_preview_widgets:
-            for i in _preview_widget.get_children():
-                _preview_widget.delete(i)
-
-        # Insert
-        for i, char in enumerate(self._address):
-            if i >= NUM_CHAR_PREVIEW_WIDGET * NUM_ROWS_IN_CHAR_PREVIEW_WIDGET:
-                break
-            _widget = self._label_preview_widgets[i // NUM_ROWS_IN_CHAR_PREVIEW_WIDGET]
-            if i in self._index_to_label:
-                _widget.insert(parent="", index=i % NUM_ROWS_IN_CHAR_PREVIEW_WIDGET,
-                               iid=i % NUM_ROWS_IN_CHAR_PREVIEW_WIDGET, values=(char, self._index_to_label[i]))
+            # Rows are inserted once and reused for every page and address
+            for row in range(NUM_ROWS_IN_CHAR_PREVIEW_WIDGET):
+                _preview_widget.insert(parent="", index=row, iid=row, values=("", ""))
+        self._rendered_char_labels = [("", "")] * CHAR_PREVIEW_PAGE_SIZE
+        self._char_preview_page = 0
+
+        # Page through addresses longer than one page
+        self._char_preview_page_frame = tk.Frame(self._bottom_left_frame)
+        self._char_preview_page_frame.grid(row=2, column=0, columnspan=num_widget, sticky=tk.W)
+        self._char_preview_prev_button = tk.Button(self._char_preview_page_frame, text="<",
+                                                   command=lambda: self._callback_char_preview_page(-1))
+        self._char_preview_next_button = tk.Button(self._char_preview_page_frame, text=">",
+                                                   command=lambda: self._callback_char_preview_page(1))
+        self._char_preview_page_string_var = tk.StringVar()
+        self._char_preview_page_label = tk.Label(self._char_preview_page_frame,
+                                                 textvariable=self._char_preview_page_string_var)
+        self._char_preview_prev_button.grid(row=0, column=0)
+        self._char_preview_page_label.grid(row=0, column=1)
+        self._char_preview_next_button.grid(row=0, column=2)
+
+    def _num_char_preview_pages(self):
+        return max((len(self._session.address) + CHAR_PREVIEW_PAGE_SIZE - 1) // CHAR_PREVIEW_PAGE_SIZE, 1)
+
+    def _callback_char_preview_page(self, step):
+        page = min(max(self._char_preview_page + step, 0), self._num_char_preview_pages() - 1)
+        if page != self._char_preview_page:
+            self._char_preview_page = page
+            self._update_label_preview()
+
+    def _update_label_preview(self, start=0, end=None):
+        # Update only rows in the current page whose char or label changed
+        address = self._session.address
+        page_start = self._char_preview_page * CHAR_PREVIEW_PAGE_SIZE
+        first = max(start, page_start)
+        last = page_start + CHAR_PREVIEW_PAGE_SIZE if end is None else min(page_start + CHAR_PREVIEW_PAGE_SIZE, end)
+        for i in range(first, last):
+            row = i - page_start
+            if i < len(address):
+                label = self._session.annotation.label_at(i)
+                values = (address[i], label if label is not None else "")
             else:
-                _widget.insert(parent="", index=i % NUM_ROWS_IN_CHAR_PREVIEW_WIDGET,
-                               iid=i % NUM_ROWS_IN_CHAR_PREVIEW_WIDGET, values=(char, ""))
-
-    def _update_preview(self):
-        self._update_label_preview()
+                values = ("", "")
+            if values != self._rendered_char_labels[row]:
+                _widget = self._label_preview_widgets[row // NUM_ROWS_IN_CHAR_PREVIEW_WIDGET]
+                _widget.item(row % NUM_ROWS_IN_CHAR_PREVIEW_WIDGET, values=values)
+                self._rendered_char_labels[row] = values
+
+        self._char_preview_page_string_var.set(
+            f"{min(page_start + 1, len(address))}-{min(page_start + CHAR_PREVIEW_PAGE_SIZE, len(address))}"
+            f" / {len(address)} chars")
+
+    @timed("render")
+    def _update_preview(self, start=0, end=None):
+        self._update_label_preview(start, end)
         self._update_dict_label_preview()
 
     def _init_clear_widget(self):
@@ -341,14 +404,11 @@ class AnnotatorApp:
         self.clear_button.grid(row=0, column=0)
 
     def _callback_clear(self):
-        self._refresh()
-        self._update_preview()
+        self._update_preview(*self._session.clear())
 
     def _refresh(self):
         self.selected_token = None
         self.selected_label = None
-        self._label_to_words = {label: "" for label in self._classes}
-        self._index_to_label = {}
         self._enter_mode = EnterMode.IDLE
 
     def _bind_widget_to_mode(self, widget, enter_mode: EnterMode):
@@ -364,10 +424,66 @@ def main():
     parser.add_argument("-i", "--input_file", type=str, required=True)
     parser.add_argument("-o", "--output_dir", type=str, help="If not specified, use same directory as input file")
     parser.add_argument("-r", "--resume", action="store_true")
+    parser.add_argument("--prefetch_window", type=int, default=5,
+                        help="Number of upcoming addresses to run the estimator on in background. 0 to disable.")
+    parser.add_argument("--prefetch_workers", type=int, default=1,
+                        help="Number of background estimator threads. They share one parser, which parses one "
+                             "address at a time unless it sets thread_safe.")
+    parser.add_argument("--parser", type=str, default=DEFAULT_PARSER,
+                        help=f"Parser to estimate labels: one of {sorted(PARSERS)}, module.path:ClassName, "
+                             f"or {NO_PARSER} to run without estimator")
+    parser.add_argument("--estimator_timeout", type=float,
+                        help="Run the parser in a separate process, and show addresses without estimation when "
+                             "the parser takes longer than this many seconds or crashes")
+    parser.add_argument("-p", "--preannotated", action="store_true",
+                        help="Input file is a sidecar written by preannotate.py. The estimator is not run.")
+    parser.add_argument("--parse_cache", type=str,
+                        help=f"Path to persistent cache of parser results. If not specified, use "
+                             f"{PARSE_CACHE_FILE_NAME} in output directory")
+    parser.add_argument("--parse_cache_size", type=int, default=1000000,
+                        help="Max number of addresses in the parse cache")
+    parser.add_argument("--no_parse_cache", action="store_true")
+    parser.add_argument("--flush_every", type=int, default=1,
+                        help="Write labelled records to output files every N records")
+    parser.add_argument("--flush_interval", type=float,
+                        help="Also write labelled records to output files every T seconds")
+    parser.add_argument("--fsync", action="store_true", help="fsync output files on every flush")
+    parser.add_argument("--profile_output", type=str,
+                        help="Record latency of each stage and write histograms to this .json or .csv file "
+                             "on exit or on SIGUSR1")
+    parser.add_argument("--char_label_format", type=str, choices=["text", "span"], default="text",
+                        help="Format of char-wise label output. 'span' writes compact JSON lines of labelled spans.")
+    parser.add_argument("--group_duplicates", action="store_true",
+                        help="Show each address once, ignoring width and hyphen variants, "
+                             "and write its labels to every row with the same address")
+    parser.add_argument("--queue_block_size", type=int,
+                        help="Show addresses from the least confident estimation, scoring N addresses at a time")
+    parser.add_argument("--auto_accept", type=float,
+                        help="With --queue_block_size, write estimated labels of addresses whose confidence "
+                             "is at or above this value (0 to 1) without showing them")
+    parser.add_argument("--shard_size", type=int,
+                        help="Annotate with other processes on the same input. Each process leases shards of N rows "
+                             "and writes shard outputs, which are merged by merge_shards.py")
+    parser.add_argument("--lease_seconds", type=float, default=600,
+                        help="Shard of a process which does not respond for this duration is taken over by others")
     args = parser.parse_args(sys.argv[1:])
 
+    if args.profile_output is not None:
+        instrumentation.enable(args.profile_output)
+
     output_dir = args.output_dir if args.output_dir is not None else os.path.dirname(args.input_file)
-    app = AnnotatorApp(input_path=args.input_file, output_dir=output_dir)
+    parse_cache_path = None
+    if not args.no_parse_cache:
+        parse_cache_path = args.parse_cache if args.parse_cache is not None else os.path.join(output_dir, PARSE_CACHE_FILE_NAME)
+    app = AnnotatorApp(input_path=args.input_file, output_dir=output_dir,
+                       prefetch_window=args.prefetch_window, prefetch_workers=args.prefetch_workers,
+                       preannotated=args.preannotated,
+                       parse_cache_path=parse_cache_path, parse_cache_size=args.parse_cache_size,
+                       flush_every=args.flush_every, flush_interval=args.flush_interval, fsync=args.fsync,
+                       char_label_format=args.char_label_format, group_duplicates=args.group_duplicates,
+                       queue_block_size=args.queue_block_size, auto_accept=args.auto_accept,
+                       shard_size=args.shard_size, lease_seconds=args.lease_seconds, parser_name=args.parser,
+                       estimator_timeout=args.estimator_timeout)
     app.start(resume=args.resume)
 
 
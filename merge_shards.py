@@ -0,0 +1,137 @@
+import argparse
+from collections import defaultdict, deque
+import csv
+import os
+import sys
+from typing import Deque, Dict, List, Optional, Tuple
+
+from utils.annotation_session import CHAR_LABEL_FILE_NAME, LABELLED_FILE_NAME, SPAN_LABEL_FILE_NAME
+from utils.char_label_reader import iter_char_label_records
+from utils.char_label_writer import CharLabelWriter
+from utils.column_table import ColumnTable
+from utils.csv_writer import CSVWriter
+from utils.lazy_csv_reader import LazyCSVReader
+from utils.shard_leases import ShardLeases, shard_file_id, shard_name
+from utils.span_label_reader import SpanLabelReader
+from utils.span_label_writer import SpanLabelWriter
+
+
+def _shard_files(shard_dir: str, input_path: str, shard: int) -> Tuple[str, str]:
+    file_id = shard_file_id(input_path, shard)
+    labelled_path = os.path.join(shard_dir, f"{file_id}_{LABELLED_FILE_NAME}")
+    char_label_path = os.path.join(shard_dir, f"{file_id}_{CHAR_LABEL_FILE_NAME}")
+    if not os.path.exists(char_label_path):
+        char_label_path = os.path.join(shard_dir, f"{file_id}_{SPAN_LABEL_FILE_NAME}")
+    return labelled_path, char_label_path
+
+
+def _read_shard(data: LazyCSVReader, shard_dir: str, input_path: str, shard: int, start: int, end: int) \
+        -> Tuple[List[str], ColumnTable, List[Tuple[int, int, Tuple[str, List[str]]]]]:
+    """
+    Read records of a shard and return the header, its labelled rows, and (row index in the input, index in the
+    labelled rows, char label record) in input order.
+    """
+    labelled_path, char_label_path = _shard_files(shard_dir, input_path, shard)
+    with open(labelled_path, "r", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        header = next(reader, None)
+        # Rows are kept in columns instead of dicts, which take several times more memory
+        rows = ColumnTable(header or [])
+        for values in reader:
+            if values:
+                rows.append(values)
+    char_label_records = list(iter_char_label_records(char_label_path))
+    assert len(rows) == len(char_label_records), \
+        f"Output files of {shard_name(shard)} should have the same number of records!\n" \
+        f"  {labelled_path}: {len(rows)}\n  {char_label_path}: {len(char_label_records)}"
+
+    # Records may be in order of the uncertainty queue. Rows with the same sourceid are matched in order.
+    sourceid_to_indices: Dict[str, Deque[int]] = defaultdict(deque)
+    for i in range(start, end):
+        sourceid_to_indices[data.read_record(i)["sourceid"]].append(i)
+    records = []
+    for i, char_label_record in enumerate(char_label_records):
+        row = rows[i]
+        indices = sourceid_to_indices.get(row["sourceid"])
+        assert indices, f"Record {row['sourceid']} in {labelled_path} is not in rows {start + 1} - {end} of the input!"
+        index = indices.popleft()
+        address = data.read_record(index)["address"]
+        assert row["address"] == char_label_record[0] == address, \
+            f"Address of record {row['sourceid']} should be the same as the input!\n  Expected: {address}\n" \
+            f"  Actual: {row['address']} in {labelled_path}, {char_label_record[0]} in {char_label_path}"
+        records.append((index, i, char_label_record))
+    assert len(records) == end - start, \
+        f"{shard_name(shard)} should have {end - start} records, but has {len(records)} records."
+    records.sort(key=lambda record: record[0])
+    return header, rows, records
+
+
+def merge_shards(input_path: str, shard_dir: str, output_dir: str, allow_incomplete: bool = False) -> int:
+    """
+    Merge outputs of finished shards into one pair of output files in input order.
+    Each shard is loaded one at a time, so the memory usage is bounded by the shard size.
+    """
+    leases_path = ShardLeases.path_for(shard_dir, input_path)
+    assert os.path.exists(leases_path), f"No shard is found for {input_path} in {shard_dir}!"
+    leases = ShardLeases(leases_path)
+    shards = leases.shards()
+    leases.close()
+
+    incomplete_shards = [shard_name(shard) for shard, _, _, done in shards if not done]
+    if incomplete_shards:
+        message = f"{len(incomplete_shards)} shards are not finished: {', '.join(incomplete_shards)}"
+        assert allow_incomplete, f"{message}. Use --allow_incomplete to merge only finished shards."
+        print(f"{message}. They are skipped.")
+    shards = [(shard, start, end) for shard, start, end, done in shards if done]
+    if not shards:
+        return 0
+
+    os.makedirs(output_dir, exist_ok=True)
+    data = LazyCSVReader.from_file(path=input_path, sep="\t")
+    writer: Optional[CSVWriter] = None
+    char_label_writer = None
+    num_records = 0
+    try:
+        for shard, start, end in shards:
+            header, rows, records = _read_shard(data, shard_dir, input_path, shard, start, end)
+            if writer is None:
+                writer = CSVWriter(os.path.join(output_dir, LABELLED_FILE_NAME), sep="\t", header=header,
+                                   flush_every=1000)
+                # Format of char label file follows shard outputs
+                char_label_path = _shard_files(shard_dir, input_path, shard)[1]
+                if char_label_path.endswith(SPAN_LABEL_FILE_NAME):
+                    char_label_writer = SpanLabelWriter(os.path.join(output_dir, SPAN_LABEL_FILE_NAME),
+                                                        labels=SpanLabelReader(char_label_path).labels,
+                                                        flush_every=1000)
+                else:
+                    char_label_writer = CharLabelWriter(os.path.join(output_dir, CHAR_LABEL_FILE_NAME),
+                                                        flush_every=1000)
+            for _, i, (address, char_labels) in records:
+                writer.append_dict(rows[i])
+                char_label_writer.append(address, char_labels)
+            num_records += len(records)
+    finally:
+        if writer is not None:
+            writer.close()
+            char_label_writer.close()
+        data.close()
+    return num_records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge outputs of shards annotated with main.py --shard_size "
+                                                 "into one labelled file and char label file in input order.")
+    parser.add_argument("-i", "--input_file", type=str, required=True)
+    parser.add_argument("-d", "--shard_dir", type=str, help="Output directory of annotators (Default: input dir)")
+    parser.add_argument("-o", "--output_dir", type=str, help="Default: merged directory in the shard directory")
+    parser.add_argument("--allow_incomplete", action="store_true", help="Merge only finished shards")
+    args = parser.parse_args(sys.argv[1:])
+
+    shard_dir = args.shard_dir if args.shard_dir is not None else os.path.dirname(args.input_file)
+    output_dir = args.output_dir if args.output_dir is not None else os.path.join(shard_dir, "merged")
+    num_records = merge_shards(args.input_file, shard_dir, output_dir, allow_incomplete=args.allow_incomplete)
+    print(f"Merged {num_records} records into {output_dir}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
-from abs import ABCMeta, abstractmethod
+from abc import ABCMeta, abstractmethod
 
 class DummyParser(metaclass=ABCMeta):
     """
     Dummy parser class. You can implement any parser as long as it has parse() method.
+    Parsers are called from prefetch threads one at a time, unless they set thread_safe to True.
     """
+    thread_safe = False
+
     def __init__(self):
         pass
 
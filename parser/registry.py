@@ -0,0 +1,65 @@
+import importlib
+import threading
+import time
+from typing import Dict, Optional
+
+# Parsers implementing DummyParser.parse(), by name. Modules are imported only when the parser is used.
+PARSERS: Dict[str, str] = {
+    "crf": "parser.crf_parser:CRFParser",
+}
+DEFAULT_PARSER = "crf"
+# Run without estimator
+NO_PARSER = "none"
+
+
+def register_parser(name: str, spec: str):
+    assert name != NO_PARSER, f"{NO_PARSER} is reserved for running without estimator."
+    PARSERS[name] = spec
+
+
+def load_parser_class(name: str):
+    """
+    Import the parser class of a registered name, or of "module.path:ClassName".
+    """
+    spec = PARSERS.get(name, name)
+    assert ":" in spec, f"Unknown parser: {name}. Use one of {sorted(PARSERS)} or module.path:ClassName."
+    module_name, class_name = spec.split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class ParserLoader:
+    """
+    Imports and builds a parser on a background thread, so that startup doesn't wait for loading the model.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.parser_class = None
+        self.load_seconds: Optional[float] = None
+        self._parser = None
+        self._error: Optional[BaseException] = None
+        self._loaded = threading.Event()
+        self._thread = threading.Thread(target=self._load, name=f"load-parser-{name}", daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            self.parser_class = load_parser_class(self.name)
+            self._parser = self.parser_class()
+        except BaseException as e:
+            self._error = e
+        self.load_seconds = time.perf_counter() - start
+        self._loaded.set()
+
+    def ready(self) -> bool:
+        return self._loaded.is_set()
+
+    def get(self):
+        """
+        Return the parser, waiting for it to be loaded.
+        """
+        self._loaded.wait()
+        if self._error is not None:
+            raise RuntimeError(f"Failed to load parser {self.name}") from self._error
+        return self._parser
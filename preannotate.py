@@ -0,0 +1,124 @@
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+from typing import Dict, List
+
+from constants import CLASSES
+from parser.registry import DEFAULT_PARSER, NO_PARSER, PARSERS, load_parser_class
+from utils.lazy_csv_reader import LazyCSVReader
+
+PREANNOTATED_SUFFIX = ".preannotated.tsv"
+
+_worker_parser = None
+
+
+def _init_worker(parser_spec: str):
+    global _worker_parser
+    _worker_parser = load_parser_class(parser_spec)()
+
+
+def _parse_chunk(addresses: List[str]) -> List[Dict[str, str]]:
+    return [{k.lower(): v for k, v in _worker_parser.parse(address).items()} for address in addresses]
+
+
+def _clean(value: str) -> str:
+    return value.replace("\t", " ").replace("\n", " ").replace("\r", " ").strip()
+
+
+def _count_completed_rows(path: str, header_line: str) -> int:
+    """
+    Count rows already written to the sidecar, dropping a partially written last row.
+    """
+    with open(path, "rb+") as f:
+        first_line = f.readline()
+        if not first_line.endswith(b"\n"):
+            f.truncate(0)
+            return -1
+        assert first_line.decode("utf-8") == header_line, \
+            f"Header of existing output doesn't match!\n  Expected: {header_line}  Actual: {first_line.decode('utf-8')}"
+        num_rows = 0
+        last_complete = f.tell()
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            num_rows += 1
+            last_complete += len(line)
+        f.truncate(last_complete)
+    return num_rows
+
+
+def preannotate(input_path: str, output_path: str, parser_spec: str, num_workers: int, chunk_size: int):
+    reader = LazyCSVReader.from_file(path=input_path, sep="\t")
+    header = reader.get_header()
+    assert "address" in header, f"CSV file should have columns 'address'!"
+    assert parser_spec != NO_PARSER, "Parser is required to pre-annotate!"
+    # Fail before starting workers if the parser cannot be imported
+    load_parser_class(parser_spec)
+    output_header = header + [label for label in CLASSES if label not in header]
+    header_line = "\t".join(output_header) + "\n"
+
+    # Resume from previous run
+    start = -1
+    if os.path.exists(output_path):
+        start = _count_completed_rows(output_path, header_line)
+    if start < 0:
+        with open(output_path, "w") as f:
+            f.write(header_line)
+        start = 0
+    print(f"Pre-annotating {len(reader) - start} / {len(reader)} records with {parser_spec}.")
+
+    def _chunks():
+        for chunk_start in range(start, len(reader), chunk_size):
+            chunk_end = min(chunk_start + chunk_size, len(reader))
+            yield [reader.read_record(i) for i in range(chunk_start, chunk_end)]
+
+    num_done = start
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(parser_spec,)) as executor, \
+            open(output_path, "a") as f:
+        # Bound the number of chunks in flight so the input is never loaded at once
+        pending = deque()
+        chunks = _chunks()
+        for records in chunks:
+            pending.append((records, executor.submit(_parse_chunk, [r["address"] for r in records])))
+            if len(pending) < 4 * num_workers:
+                continue
+            num_done += _write_chunk(f, output_header, *pending.popleft())
+            print(f"{num_done} / {len(reader)}", end="\r")
+        while pending:
+            num_done += _write_chunk(f, output_header, *pending.popleft())
+            print(f"{num_done} / {len(reader)}", end="\r")
+    reader.close()
+    print(f"\nWrote pre-annotated records to {output_path}.")
+
+
+def _write_chunk(f, output_header: List[str], records: List[Dict[str, str]], future) -> int:
+    for record, parsed_result in zip(records, future.result()):
+        for key in CLASSES:
+            if key not in record:  # Use existing one
+                record[key] = parsed_result.get(key, "")
+        f.write("\t".join(_clean(record[col]) for col in output_header) + "\n")
+    # Only whole chunks are written so an interrupted run resumes at a row boundary
+    f.flush()
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the weak estimator over the whole input in advance.")
+    parser.add_argument("-i", "--input_file", type=str, required=True)
+    parser.add_argument("-o", "--output_file", type=str,
+                        help=f"If not specified, write to <input_file>{PREANNOTATED_SUFFIX}")
+    parser.add_argument("--parser", type=str, default=DEFAULT_PARSER,
+                        help=f"Parser to use: one of {sorted(PARSERS)} or module.path:ClassName")
+    parser.add_argument("-j", "--num_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk_size", type=int, default=256)
+    args = parser.parse_args(sys.argv[1:])
+
+    output_path = args.output_file if args.output_file is not None else args.input_file + PREANNOTATED_SUFFIX
+    preannotate(input_path=args.input_file, output_path=output_path, parser_spec=args.parser,
+                num_workers=args.num_workers, chunk_size=args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
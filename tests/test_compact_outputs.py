@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from compact_outputs import compact
+from utils.annotation_session import LABELLED_FILE_NAME, AnnotationSession
+from utils.csv_reader_wrapper import CSVReaderWrapperWithWeakEstimator
+
+
+def _annotate(input_path: str, output_dir: str, addresses):
+    with open(input_path, "w") as f:
+        f.write("sourceid\taddress\n")
+        for i, address in enumerate(addresses):
+            f.write(f"{i}\t{address}\n")
+    data = CSVReaderWrapperWithWeakEstimator.from_file(input_path, "\t", parser_name="none")
+    session = AnnotationSession(data, input_path, output_dir)
+    session.open()
+    while session.has_next():
+        session.next_record()
+        session.commit()
+    session.close()
+
+
+def test_compact_sessions_of_one_input(tmp_path):
+    output_dir = str(tmp_path / "out")
+    os.makedirs(output_dir)
+    # Sourceids of the inputs overlap, and input a has two sessions
+    _annotate(str(tmp_path / "a.tsv"), output_dir, ["港区", "北区"])
+    _annotate(str(tmp_path / "b.tsv"), output_dir, ["横浜市", "大阪市", "京都市"])
+    _annotate(str(tmp_path / "a.tsv"), output_dir, ["港区", "北区"])
+
+    with pytest.raises(AssertionError, match="several inputs"):
+        compact(output_dir, str(tmp_path / "all"))
+
+    for name, addresses in (("a", ["港区", "北区"]), ("b", ["横浜市", "大阪市", "京都市"])):
+        compacted_dir = str(tmp_path / f"compacted_{name}")
+        stats = compact(output_dir, compacted_dir, input_path=str(tmp_path / f"{name}.tsv"))
+        assert stats["conflicts"] == 0
+        with open(os.path.join(compacted_dir, LABELLED_FILE_NAME)) as f:
+            assert [line.split("\t")[1] for line in f.read().splitlines()[1:]] == addresses
@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from evaluate_parser import evaluate
+from utils.char_label_writer import CharLabelWriter
+
+
+class BrokenParser:
+    def __init__(self):
+        raise OSError("Model file is not found")
+
+    def parse(self, address: str):
+        return {}
+
+
+@pytest.mark.parametrize("parser_name", ["tests.test_evaluate_parser:BrokenParser", "no_such_module:Parser"])
+def test_parser_that_cannot_be_built(tmp_path, parser_name):
+    path = str(tmp_path / "char_label.txt")
+    writer = CharLabelWriter(path)
+    writer.append("港区", ["ward", "ward"])
+    writer.close()
+    with pytest.raises(RuntimeError, match="cannot be loaded"):
+        evaluate(path, parser_name, num_workers=2)
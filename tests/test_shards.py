@@ -0,0 +1,40 @@
+import os
+
+from merge_shards import merge_shards
+from utils.annotation_session import LABELLED_FILE_NAME, AnnotationSession
+from utils.csv_reader_wrapper import CSVReaderWrapperWithWeakEstimator
+from utils.shard_leases import ShardLeases
+
+
+def _write_input(path: str, name: str, num_rows: int):
+    with open(path, "w") as f:
+        f.write("sourceid\taddress\n")
+        for i in range(num_rows):
+            f.write(f"{name}{i}\t東京都港区{name}{i}丁目\n")
+
+
+def _annotate_all(input_path: str, output_dir: str):
+    data = CSVReaderWrapperWithWeakEstimator.from_file(input_path, "\t", parser_name="none")
+    leases = ShardLeases.open(ShardLeases.path_for(output_dir, input_path), len(data), 2)
+    session = AnnotationSession(data, input_path, output_dir, leases=leases)
+    session.open()
+    while session.has_next():
+        session.next_record()
+        session.commit()
+    session.close()
+
+
+def test_shards_of_inputs_sharing_output_dir(tmp_path):
+    output_dir = str(tmp_path / "out")
+    os.makedirs(output_dir)
+    for name in ("a", "b"):
+        input_path = str(tmp_path / f"{name}.tsv")
+        _write_input(input_path, name, 4)
+        _annotate_all(input_path, output_dir)
+
+    for name in ("a", "b"):
+        merged_dir = str(tmp_path / f"merged_{name}")
+        assert merge_shards(str(tmp_path / f"{name}.tsv"), output_dir, merged_dir) == 4
+        with open(os.path.join(merged_dir, LABELLED_FILE_NAME)) as f:
+            sourceids = [line.split("\t")[0] for line in f.read().splitlines()[1:]]
+        assert sourceids == [f"{name}{i}" for i in range(4)]
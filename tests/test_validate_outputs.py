@@ -0,0 +1,39 @@
+import pytest
+
+from constants import CLASSES, ERASED_LABEL
+from utils.char_label_writer import CharLabelWriter
+from utils.csv_writer import CSVWriter
+from validate_outputs import validate
+
+RECORDS = [("港区", ["ward", "ward"]), ("x", [ERASED_LABEL]), ("北区", ["ward", "ward"])]
+
+
+def _write_outputs(tmp_path):
+    labelled_path, char_label_path = str(tmp_path / "s_labelled.txt"), str(tmp_path / "s_char_label.txt")
+    with CSVWriter(labelled_path, sep="\t", header=["sourceid", "address", *CLASSES]) as writer, \
+            CharLabelWriter(char_label_path) as char_label_writer:
+        for i, (address, labels) in enumerate(RECORDS):
+            writer.append_dict({"sourceid": str(i), "address": address,
+                                **{label: address if label in labels else "" for label in CLASSES}})
+            char_label_writer.append(address, labels)
+    return labelled_path, char_label_path
+
+
+def _violations(pairs):
+    return [violation for _, violations in validate(pairs, num_workers=0) for violation in violations]
+
+
+def test_erased_one_char_address_is_valid(tmp_path):
+    assert _violations([_write_outputs(tmp_path)]) == []
+
+
+@pytest.mark.parametrize("edit", [lambda lines: lines[:1] + lines[2:], lambda lines: lines[:2] + lines[1:]],
+                         ids=["missing_line", "extra_line"])
+def test_broken_layout_breaks_only_its_record(tmp_path, edit):
+    labelled_path, char_label_path = _write_outputs(tmp_path)
+    with open(char_label_path) as f:
+        lines = f.readlines()
+    with open(char_label_path, "w") as f:
+        f.writelines(edit(lines))
+    violations = _violations([(labelled_path, char_label_path)])
+    assert [violation["record"] for violation in violations] == [0]
@@ -0,0 +1,37 @@
+from typing import Dict, List, Tuple
+
+
+def align_predictions(address: str, predictions: Dict[str, str], classes: List[str]) -> List[Tuple[int, int, str]]:
+    """
+    Map predicted segment values onto the address in one left-to-right pass and return (start, end, label) spans.
+    At each position, only values starting with the character there are compared. When several unmatched values
+    match at the same position, the class earlier in `classes` wins. Matched characters are consumed, so
+    a repeated substring is assigned to the next occurrence instead of the first one.
+    """
+    # First char -> [(rank, label, value)]
+    candidates: Dict[str, List[Tuple[int, str, str]]] = {}
+    for rank, label in enumerate(classes):
+        value = predictions.get(label)
+        if value:
+            candidates.setdefault(value[0], []).append((rank, label, value))
+    for values in candidates.values():
+        values.sort()
+
+    spans = []
+    num_remaining = sum(len(values) for values in candidates.values())
+    i = 0
+    while i < len(address) and num_remaining > 0:
+        values = candidates.get(address[i])
+        if values:
+            for j, (_, label, value) in enumerate(values):
+                if address.startswith(value, i):
+                    spans.append((i, i + len(value), label))
+                    del values[j]
+                    num_remaining -= 1
+                    i += len(value)
+                    break
+            else:
+                i += 1
+        else:
+            i += 1
+    return spans
@@ -0,0 +1,150 @@
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from constants import OUTSIDE_LABEL
+
+Span = Tuple[int, int, str]
+
+
+class AnnotationModel:
+    """
+    Labels of an address kept as sorted, non-overlapping (start, end, label) spans.
+    Adjacent spans of the same label are merged, and words of each class are updated only for changed labels.
+    """
+
+    def __init__(self, classes: List[str], address: str = ""):
+        self._classes = classes
+        self.reset(address)
+
+    def reset(self, address: str, spans: Iterable[Span] = ()):
+        """
+        Start labelling the address with initial spans, which must be sorted and non-overlapping.
+        Initial spans are not recorded in the undo history.
+        """
+        self.address = address
+        self._starts: List[int] = []
+        self._spans: List[Span] = []
+        # label -> {start: end}
+        self._label_spans: Dict[str, Dict[int, int]] = {}
+        self._words = {label: "" for label in self._classes}
+        self._undo_stack: List[Tuple[List[Span], List[Span]]] = []
+        self._redo_stack: List[Tuple[List[Span], List[Span]]] = []
+        spans = list(spans)
+        if spans:
+            self._replace([], spans)
+
+    def set_label(self, start: int, end: int, label: str) -> Tuple[int, int]:
+        """
+        Label characters in [start, end). Returns the range of characters whose label may have changed.
+        """
+        start, end = max(start, 0), min(end, len(self.address))
+        if start >= end:
+            return start, start
+        first = bisect_left(self._starts, start)
+        # Include the previous span if it overlaps the range to split it, or touches it with the same label to merge
+        if first > 0:
+            _, prev_end, prev_label = self._spans[first - 1]
+            if prev_end > start or (prev_end == start and prev_label == label):
+                first -= 1
+        last = bisect_left(self._starts, end)
+        if last < len(self._spans) and self._spans[last][0] == end and self._spans[last][2] == label:
+            last += 1
+        removed = self._spans[first:last]
+
+        added = []
+        new_start, new_end = start, end
+        for s, e, l in removed:
+            if l == label:
+                # Merge
+                new_start, new_end = min(new_start, s), max(new_end, e)
+            else:
+                if s < start:
+                    added.append((s, start, l))
+                if e > end:
+                    added.append((end, e, l))
+        added.append((new_start, new_end, label))
+        added.sort()
+        if removed == added:
+            return start, start
+        self._replace(removed, added)
+        self._undo_stack.append((removed, added))
+        self._redo_stack.clear()
+        return start, end
+
+    def clear(self) -> Tuple[int, int]:
+        removed = list(self._spans)
+        if removed:
+            self._replace(removed, [])
+            self._undo_stack.append((removed, []))
+            self._redo_stack.clear()
+        return 0, len(self.address)
+
+    def undo(self) -> Tuple[int, int]:
+        if not self._undo_stack:
+            return 0, 0
+        removed, added = self._undo_stack.pop()
+        self._replace(added, removed)
+        self._redo_stack.append((removed, added))
+        return _span_range(removed + added)
+
+    def redo(self) -> Tuple[int, int]:
+        if not self._redo_stack:
+            return 0, 0
+        removed, added = self._redo_stack.pop()
+        self._replace(removed, added)
+        self._undo_stack.append((removed, added))
+        return _span_range(removed + added)
+
+    def _replace(self, removed: List[Span], added: List[Span]):
+        changed_labels: Set[str] = set()
+        for span in removed:
+            index = bisect_left(self._starts, span[0])
+            del self._starts[index]
+            del self._spans[index]
+            del self._label_spans[span[2]][span[0]]
+            changed_labels.add(span[2])
+        for span in added:
+            index = bisect_left(self._starts, span[0])
+            self._starts.insert(index, span[0])
+            self._spans.insert(index, span)
+            self._label_spans.setdefault(span[2], {})[span[0]] = span[1]
+            changed_labels.add(span[2])
+        for label in changed_labels:
+            if label in self._words:
+                label_spans = self._label_spans.get(label, {})
+                self._words[label] = "".join(self.address[s:label_spans[s]] for s in sorted(label_spans))
+
+    def has_edits(self) -> bool:
+        return bool(self._undo_stack)
+
+    def label_at(self, index: int) -> Optional[str]:
+        i = bisect_right(self._starts, index) - 1
+        if i >= 0 and index < self._spans[i][1]:
+            return self._spans[i][2]
+        return None
+
+    def spans(self) -> List[Span]:
+        return list(self._spans)
+
+    def words(self) -> Dict[str, str]:
+        return dict(self._words)
+
+    def char_labels(self, default: str = OUTSIDE_LABEL) -> List[str]:
+        labels = [default] * len(self.address)
+        for start, end, label in self._spans:
+            labels[start:end] = [label] * (end - start)
+        return labels
+
+
+def words_from_spans(address: str, spans: Iterable[Span], classes: List[str]) -> Dict[str, str]:
+    words = {label: "" for label in classes}
+    for start, end, label in spans:
+        if label in words:
+            words[label] += address[start:end]
+    return words
+
+
+def _span_range(spans: List[Span]) -> Tuple[int, int]:
+    if not spans:
+        return 0, 0
+    return min(s for s, _, _ in spans), max(e for _, e, _ in spans)
@@ -0,0 +1,65 @@
+import heapq
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils.aligner import align_predictions
+
+
+def prediction_confidence(address: str, predictions: Dict[str, str], classes: List[str]) -> float:
+    """
+    Confidence of the estimator for an address in [0, 1]: ratio of characters covered by predicted values,
+    discounted by the ratio of predicted values which are not found in the address.
+    """
+    values = [predictions[label] for label in classes if predictions.get(label)]
+    if not address or not values:
+        return 0.0
+    spans = align_predictions(address, predictions, classes)
+    covered = sum(end - start for start, end, _ in spans)
+    return covered / len(address) * len(spans) / len(values)
+
+
+class UncertaintyQueue:
+    """
+    Serves items in blocks of block_size items in input order. Items of a block are scored when the block is
+    first reached; those with confidence at or above auto_accept come first, then the rest from the least confident.
+    The order only depends on the scores, so a position in the queue points to the same item across sessions.
+    """
+
+    def __init__(self, num_items: int, score_block: Callable[[range], List[Tuple[float, Dict[str, str]]]],
+                 block_size: int, auto_accept: Optional[float] = None):
+        assert block_size > 0, f"Block size should be positive, but got {block_size}."
+        self._num_items = num_items
+        self._score_block = score_block
+        self._block_size = block_size
+        self._auto_accept = auto_accept
+
+        self._block_index = -1
+        self._served = []  # [(item, record, auto_accepted)] in order of the queue
+        self._heap = []  # [(confidence, item, record)]
+
+    def __len__(self):
+        return self._num_items
+
+    def get(self, position: int) -> Tuple[int, Dict[str, str], bool]:
+        """
+        Return (item, record, auto_accepted) at the position of the queue.
+        """
+        assert 0 <= position < self._num_items, f"Position {position} is out of the queue of {self._num_items} items."
+        block_index, offset = divmod(position, self._block_size)
+        if block_index != self._block_index:
+            self._load_block(block_index)
+        while len(self._served) <= offset:
+            _, item, record = heapq.heappop(self._heap)
+            self._served.append((item, record, False))
+        return self._served[offset]
+
+    def _load_block(self, block_index: int):
+        items = range(block_index * self._block_size, min((block_index + 1) * self._block_size, self._num_items))
+        self._block_index = block_index
+        self._served = []
+        self._heap = []
+        for item, (confidence, record) in zip(items, self._score_block(items)):
+            if self._auto_accept is not None and confidence >= self._auto_accept:
+                self._served.append((item, record, True))
+            else:
+                self._heap.append((confidence, item, record))
+        heapq.heapify(self._heap)
@@ -0,0 +1,400 @@
+from collections import deque
+import datetime
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from constants import CLASSES, ERASE, ERASED_LABEL, SPAN_LABEL_FILE_EXTENSION
+from utils.aligner import align_predictions
+from utils.annotation_model import AnnotationModel, words_from_spans
+from utils.annotation_queue import UncertaintyQueue, prediction_confidence
+from utils.checkpoint import Checkpoint
+from utils.char_label_writer import CharLabelWriter
+from utils.csv_writer import CSVWriter
+from utils.duplicate_index import DuplicateIndex
+from utils.instrumentation import timed
+from utils.shard_leases import LeaseLostError, ShardLeases, is_shard_file, shard_file_id, shard_name
+from utils.span_label_writer import SpanLabelWriter
+
+LABELLED_FILE_NAME = "labelled.txt"
+CHAR_LABEL_FILE_NAME = "char_label.txt"
+SPAN_LABEL_FILE_NAME = "char_label" + SPAN_LABEL_FILE_EXTENSION
+
+
+class AnnotationSession:
+    """
+    Headless annotation session: reads records, pre-fills estimated labels, keeps labels being edited,
+    writes finished records and maintains the checkpoint. UI only forwards user actions to this class.
+    With group_duplicates, each normalized address is shown once, at its first row, and its labels are written to
+    every row with the same address. Then items are groups instead of rows.
+    With queue_block_size, items are served from the least confident estimation (see UncertaintyQueue), and
+    items whose confidence is at or above auto_accept are written with estimated labels without being shown.
+    index is the position of the current item in order of serving, which is what the checkpoint counts.
+    With leases, the session annotates shards leased from ShardLeases one after another, and items are rows of
+    the current shard. Each shard has its own output files and checkpoint, so that another process can take over it.
+    """
+
+    def __init__(self, data, input_path: str, output_dir: str, classes: List[str] = CLASSES, flush_every: int = 1,
+                 flush_interval: Optional[float] = None, fsync: bool = False, char_label_format: str = "text",
+                 group_duplicates: bool = False, queue_block_size: Optional[int] = None,
+                 auto_accept: Optional[float] = None, leases: Optional[ShardLeases] = None):
+        self._data = data
+        self._input_path = input_path
+        self._output_dir = output_dir
+        self._classes = classes
+        assert "address" in self._data.get_header(), f"CSV file should have columns 'address'!"
+        assert auto_accept is None or queue_block_size is not None, "Auto-accept is only available with the queue!"
+        assert leases is None or not group_duplicates, "Duplicates cannot be grouped across shards!"
+
+        # Output Files
+        self._flush_every = flush_every
+        self._flush_interval = flush_interval
+        self._fsync = fsync
+        self._char_label_file_name = SPAN_LABEL_FILE_NAME if char_label_format == "span" else CHAR_LABEL_FILE_NAME
+        self._writer = None
+        self._char_label_writer = None
+        self._checkpoint = None
+        self._checkpoint_path = None
+        self._pending_checkpoints = deque()
+        self._group_duplicates = group_duplicates
+        self._duplicate_index = None
+        self._queue_block_size = queue_block_size
+        self._auto_accept = auto_accept
+        self._queue = None
+        self._num_auto_accepted = 0
+        self._leases = leases
+        self._shard = None  # (shard, start row, end row)
+        self._lease_renewed_at = 0.0
+        self._lease_lost: Optional[str] = None
+
+        self.address = ""
+        self.sourceid = None
+        self.index = -1
+        self._item = -1
+        self._estimate_pending = False
+        self.annotation = AnnotationModel(self._classes)
+
+    def __len__(self):
+        if self._leases is not None:
+            return self._shard[2] - self._shard[1] if self._shard is not None else 0
+        if self._duplicate_index is not None:
+            return len(self._duplicate_index)
+        return len(self._data)
+
+    def _rows(self, index: int) -> List[int]:
+        if self._duplicate_index is not None:
+            return self._duplicate_index.groups[index]
+        if self._shard is not None:
+            return [self._shard[1] + index]
+        return [index]
+
+    def _item_at(self, position: int) -> int:
+        if self._queue is not None:
+            return self._queue.get(position)[0]
+        return position
+
+    def _upcoming_rows(self, item: int):
+        if self._duplicate_index is None and self._shard is None:
+            return None
+        return (self._rows(i)[0] for i in range(item + 1, len(self)))
+
+    def _score_block(self, items: range) -> List[Tuple[float, Dict[str, str]]]:
+        # Estimation of following items runs in background while scoring
+        scores = []
+        for item in items:
+            record = self._data.read_record(self._rows(item)[0], upcoming=self._upcoming_rows(item))
+            scores.append((prediction_confidence(record["address"], record, self._classes), record))
+        return scores
+
+    def open(self, resume: bool = False):
+        if self._group_duplicates:
+            self._duplicate_index = DuplicateIndex.build(self._data.read_record(i, estimate=False)["address"]
+                                                         for i in range(len(self._data)))
+            print(self._duplicate_index.report())
+        if self._leases is not None:
+            # Shards are always resumed from their checkpoints, which may be left by a crashed process
+            if not self._open_next_shard():
+                print(f"No shard is left to annotate. {self._leases.report()}")
+                return
+        else:
+            self._open_outputs(resume)
+        self._advance()
+
+    def _open_next_shard(self) -> bool:
+        self._shard = self._leases.claim()
+        if self._shard is None:
+            return False
+        self._lease_renewed_at = time.time()
+        shard, start, end = self._shard
+        print(f"Annotating {shard_name(shard)} (rows {start + 1} - {end}).")
+        self._open_outputs(resume=True)
+        return True
+
+    def _open_outputs(self, resume: bool):
+        header = ["sourceid", "address", *self._classes]
+        shard = self._shard[0] if self._shard is not None else None
+        self._checkpoint_path = Checkpoint.path_for(self._output_dir, self._input_path, shard=shard)
+        if self._queue_block_size is not None:
+            self._queue = UncertaintyQueue(len(self), self._score_block, block_size=self._queue_block_size,
+                                           auto_accept=self._auto_accept)
+        checkpoint = self._load_checkpoint() if resume else None
+        if checkpoint is None:
+            file_id = shard_file_id(self._input_path, shard) if shard is not None \
+                else datetime.datetime.now().isoformat().replace(":", ".")
+            checkpoint = Checkpoint(input_file=os.path.abspath(self._input_path),
+                                    labelled_file=os.path.join(self._output_dir, f"{file_id}_{LABELLED_FILE_NAME}"),
+                                    char_label_file=os.path.join(self._output_dir, f"{file_id}_{self._char_label_file_name}"),
+                                    group_duplicates=self._group_duplicates,
+                                    queue_block_size=self._queue_block_size, auto_accept=self._auto_accept)
+        else:
+            print(f"Resume from record {checkpoint.next_index + 1}, "
+                  f"appending to {checkpoint.labelled_file} and {checkpoint.char_label_file}.")
+        append = resume and os.path.exists(checkpoint.labelled_file)
+        self._writer = CSVWriter(path=checkpoint.labelled_file, sep="\t", header=header, append=append,
+                                 flush_every=self._flush_every, flush_interval=self._flush_interval, fsync=self._fsync)
+        # Format of resumed session follows its existing file
+        char_label_writer_class = SpanLabelWriter if checkpoint.char_label_file.endswith(SPAN_LABEL_FILE_EXTENSION) \
+            else CharLabelWriter
+        self._char_label_writer = char_label_writer_class(path=checkpoint.char_label_file, append=append,
+                                                          flush_every=self._flush_every,
+                                                          flush_interval=self._flush_interval, fsync=self._fsync)
+        checkpoint.labelled_offset = self._writer.offset
+        checkpoint.char_label_offset = self._char_label_writer.offset
+        checkpoint.save(self._checkpoint_path)
+        checkpoint.save_session()
+        self._checkpoint = checkpoint
+        self.index = checkpoint.next_index - 1
+
+    def has_next(self) -> bool:
+        return self.index + 1 < len(self)
+
+    @timed("next_address")
+    def next_record(self, estimate: bool = True, wait_estimator: bool = True) -> Dict[str, str]:
+        """
+        Move to the next record and pre-fill labels estimated for it. Without wait_estimator, the record is shown
+        without estimation while the parser is being loaded, and refresh_estimate() fills it in later.
+        """
+        self.index += 1
+        if self._queue is not None:
+            self._item, record, _ = self._queue.get(self.index)
+        else:
+            self._item = self.index
+            self._estimate_pending = estimate and not wait_estimator and not self._data.estimator_ready()
+            record = self._data.read_record(self._rows(self._item)[0], estimate=estimate and not self._estimate_pending,
+                                            upcoming=self._upcoming_rows(self._item))
+        self.address = record["address"]
+        self.sourceid = record["sourceid"]
+        self._prefill(record)
+        return record
+
+    def refresh_estimate(self) -> bool:
+        """
+        Pre-fill the current record once the parser is loaded, unless it has been edited. Return whether
+        the labels are updated.
+        """
+        if not self._estimate_pending or not self._data.estimator_ready():
+            return False
+        self._estimate_pending = False
+        if self.annotation.has_edits():
+            return False
+        self._prefill(self._data.read_record(self._rows(self._item)[0], upcoming=self._upcoming_rows(self._item)))
+        return True
+
+    def estimate_pending(self) -> bool:
+        return self._estimate_pending
+
+    @timed("prefill")
+    def _prefill(self, record: Dict[str, str]):
+        # Fill in pre-defined label
+        self.annotation.reset(self.address, align_predictions(self.address, record, self._classes))
+
+    @timed("update")
+    def set_label(self, start: int, end: int, label: str) -> Tuple[int, int]:
+        return self.annotation.set_label(start, end, ERASED_LABEL if label == ERASE else label)
+
+    def undo(self) -> Tuple[int, int]:
+        return self.annotation.undo()
+
+    def redo(self) -> Tuple[int, int]:
+        return self.annotation.redo()
+
+    def clear(self) -> Tuple[int, int]:
+        return self.annotation.clear()
+
+    @timed("commit")
+    def commit(self):
+        """
+        Write labels of the current record.
+        """
+        self._write_item(self._item, self.address, self.sourceid, self.annotation)
+        self._advance()
+
+    def heartbeat(self):
+        """
+        Renew the lease of the current shard if a quarter of its duration has passed. Call this periodically
+        while the annotator is idle not to lose the shard. Raises LeaseLostError if the lease has expired, after which
+        nothing is written any more.
+        """
+        if self._lease_lost is not None:
+            raise LeaseLostError(self._lease_lost)
+        if self._shard is None or time.time() - self._lease_renewed_at < self._leases.lease_seconds / 4:
+            return
+        if not self._leases.renew(self._shard[0]):
+            self._abandon_shard()
+        self._lease_renewed_at = time.time()
+
+    def _abandon_shard(self):
+        # Buffered records are dropped, since the new owner resumes the shard from its files
+        self._writer.discard()
+        self._char_label_writer.discard()
+        self._writer = None
+        self._char_label_writer = None
+        self._lease_lost = f"Lease of {shard_name(self._shard[0])} has expired and may have been taken by another " \
+                           f"annotator. Records which were not flushed yet are dropped."
+        self._shard = None
+        raise LeaseLostError(self._lease_lost)
+
+    def _write_item(self, item: int, address: str, sourceid: str, annotation: AnnotationModel):
+        # Never write to a shard leased to others
+        self.heartbeat()
+        rows = self._rows(item)
+        char_labels = annotation.char_labels()
+        for row in rows:
+            if row == rows[0]:
+                row_address, label_to_words = address, annotation.words()
+            else:
+                # Duplicate address may differ in width of chars etc., but not in length
+                record = self._data.read_record(row, estimate=False)
+                row_address, sourceid = record["address"], record["sourceid"]
+                assert len(row_address) == len(address), \
+                    f"Duplicate address should have the same length!\n  Expected: {address}\n  Actual: {row_address}"
+                label_to_words = words_from_spans(row_address, annotation.spans(), self._classes)
+
+            # Write to CSV
+            label_to_words["address"] = row_address
+            label_to_words["sourceid"] = sourceid
+            self._writer.append_dict(label_to_words)
+
+            # Write to char-label txt file
+            self._char_label_writer.append(row_address, char_labels)
+
+        self._pending_checkpoints.append((self.index + 1, self._writer.offset,
+                                          self._char_label_writer.offset, address))
+        self._update_checkpoint()
+
+    def _advance(self):
+        # Write estimated labels of confident items at the head of the queue without showing them,
+        # and move to the next shard when the current one is finished
+        while True:
+            while self._queue is not None and self.has_next():
+                item, record, auto_accepted = self._queue.get(self.index + 1)
+                if not auto_accepted:
+                    break
+                self.index += 1
+                annotation = AnnotationModel(self._classes)
+                annotation.reset(record["address"], align_predictions(record["address"], record, self._classes))
+                self._write_item(item, record["address"], record["sourceid"], annotation)
+                self._num_auto_accepted += 1
+            if self._shard is None or self.has_next():
+                return
+            self._close_outputs()
+            self._leases.complete(self._shard[0])
+            print(f"Finished {shard_name(self._shard[0])}. {self._leases.report()}")
+            if not self._open_next_shard():
+                return
+
+    def flush(self):
+        if self._writer is None:
+            return
+        # Never write to a shard leased to others
+        self.heartbeat()
+        self._writer.flush()
+        self._char_label_writer.flush()
+        self._update_checkpoint()
+
+    def _close_outputs(self):
+        # Flush buffered records
+        if self._writer is not None:
+            self._writer.close()
+            self._char_label_writer.close()
+            self._update_checkpoint()
+            self._writer = None
+            self._char_label_writer = None
+
+    def close(self):
+        if self._shard is not None:
+            try:
+                self.heartbeat()
+            except LeaseLostError as e:
+                print(e)
+        self._close_outputs()
+        if self._shard is not None:
+            self._leases.release(self._shard[0])
+            self._shard = None
+        if self._leases is not None:
+            self._leases.close()
+        if self._num_auto_accepted > 0:
+            print(f"Auto-accepted {self._num_auto_accepted} confident records in this session.")
+        self._data.close()
+
+    def _load_checkpoint(self) -> Optional[Checkpoint]:
+        checkpoint = Checkpoint.load(self._checkpoint_path)
+        if checkpoint is None:
+            if self._shard is not None:
+                return None
+            checkpoint = self._checkpoint_from_latest_outputs()
+            if checkpoint is None:
+                print("No previous session to resume. Start from the first record.")
+                return None
+        assert os.path.abspath(self._input_path) == checkpoint.input_file, \
+            f"Checkpoint is for another input file!\n  Expected: {os.path.abspath(self._input_path)}\n  Actual: {checkpoint.input_file}"
+        assert self._group_duplicates == checkpoint.group_duplicates, \
+            f"Previous session was {'' if checkpoint.group_duplicates else 'not '}run with duplicate grouping!"
+        # Order of the queue depends on these parameters
+        assert (self._queue_block_size, self._auto_accept) == (checkpoint.queue_block_size, checkpoint.auto_accept), \
+            f"Queue of previous session should be the same!\n  Expected: block size {checkpoint.queue_block_size}, " \
+            f"auto-accept {checkpoint.auto_accept}\n  Actual: block size {self._queue_block_size}, auto-accept {self._auto_accept}"
+        checkpoint.repair(labelled_header_size=self._labelled_header_size(),
+                          num_records_of=lambda position: len(self._rows(self._item_at(position))))
+        if checkpoint.last_address is not None and checkpoint.next_index > 0:
+            row = self._rows(self._item_at(checkpoint.next_index - 1))[0]
+            address = self._data.read_record(row, estimate=False)["address"]
+            assert address == checkpoint.last_address, \
+                f"Address in resume record should be same as current input!\n  Expected: {address}\n  Actual: {checkpoint.last_address}"
+        return checkpoint
+
+    def _checkpoint_from_latest_outputs(self) -> Optional[Checkpoint]:
+        # Sessions before checkpoints were introduced. Output files are scanned once in Checkpoint.repair.
+        all_paths = os.listdir(self._output_dir)
+        labelled_paths = sorted(p for p in all_paths
+                                if p.endswith("_" + LABELLED_FILE_NAME) and not is_shard_file(p))
+        char_label_paths = sorted(p for p in all_paths
+                                  if p.endswith("_" + self._char_label_file_name) and not is_shard_file(p))
+        if not labelled_paths or not char_label_paths:
+            return None
+        return Checkpoint.from_outputs(input_file=os.path.abspath(self._input_path),
+                                       labelled_file=os.path.join(self._output_dir, labelled_paths[-1]),
+                                       char_label_file=os.path.join(self._output_dir, char_label_paths[-1]),
+                                       labelled_header_size=self._labelled_header_size(),
+                                       group_duplicates=self._group_duplicates,
+                                       queue_block_size=self._queue_block_size, auto_accept=self._auto_accept)
+
+    def _labelled_header_size(self) -> int:
+        return len(("\t".join(["sourceid", "address", *self._classes]) + "\r\n").encode("utf-8"))
+
+    def _update_checkpoint(self):
+        # Save the last record whose bytes are all written to both output files
+        updated = False
+        while self._pending_checkpoints:
+            next_index, labelled_offset, char_label_offset, address = self._pending_checkpoints[0]
+            if labelled_offset > self._writer.flushed_offset or \
+                    char_label_offset > self._char_label_writer.flushed_offset:
+                break
+            self._pending_checkpoints.popleft()
+            self._checkpoint.next_index = next_index
+            self._checkpoint.labelled_offset = labelled_offset
+            self._checkpoint.char_label_offset = char_label_offset
+            self._checkpoint.last_address = address
+            updated = True
+        if updated:
+            self._checkpoint.save(self._checkpoint_path)
@@ -0,0 +1,86 @@
+import os
+import time
+from typing import List, Optional
+
+from utils.compression import compress, compression_of_extension, detect_compression, scan_streams
+from utils.instrumentation import timed
+
+
+class BufferedFileWriter:
+    """
+    Base class of writers which keep the output file open and buffer records.
+    Buffered records are written to the file every flush_every records or every flush_interval seconds,
+    whichever comes first, and optionally fsync-ed.
+    Paths ending with .gz, .bz2 or .xz are written compressed, one independent stream per flush, so a crash loses
+    at most the block being flushed. The cut block is dropped when the file is appended to.
+    Offsets of compressed files count decompressed bytes.
+    """
+
+    def __init__(self, path: str, append: bool = False, flush_every: int = 1, flush_interval: Optional[float] = None,
+                 fsync: bool = False):
+        self._path = path
+        self._flush_every = flush_every
+        self._flush_interval = flush_interval
+        self._fsync = fsync
+
+        self._compression = detect_compression(path) if append else compression_of_extension(path)
+        if self._compression is not None and append and os.path.exists(path):
+            self._file = open(path, "rb+")
+            complete_size, decompressed_size = scan_streams(path, self._compression)
+            if self._file.seek(0, os.SEEK_END) > complete_size:
+                print(f"Dropped the last block of {path} which is cut in the middle.")
+                self._file.truncate(complete_size)
+            self._file.seek(complete_size)
+        else:
+            self._file = open(path, "ab" if append else "wb")
+            decompressed_size = None
+        # Bytes written including buffered ones, and bytes actually written to the file
+        self.offset = decompressed_size if decompressed_size is not None else self._file.seek(0, os.SEEK_END)
+        self.flushed_offset = self.offset
+        self._buffer: List[bytes] = []
+        self._num_buffered = 0
+        self._last_flush = time.monotonic()
+
+    def _write(self, text: str):
+        data = text.encode("utf-8")
+        self._buffer.append(data)
+        self.offset += len(data)
+
+    def _end_record(self):
+        self._num_buffered += 1
+        if self._num_buffered >= self._flush_every or \
+                (self._flush_interval is not None and time.monotonic() - self._last_flush >= self._flush_interval):
+            self.flush()
+
+    @timed("flush")
+    def flush(self):
+        if self._buffer:
+            data = b"".join(self._buffer)
+            self._file.write(compress(data, self._compression) if self._compression is not None else data)
+            self._buffer.clear()
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+        self.flushed_offset = self.offset
+        self._num_buffered = 0
+        self._last_flush = time.monotonic()
+
+    def discard(self):
+        """
+        Close the file without writing buffered records.
+        """
+        self._buffer.clear()
+        self._num_buffered = 0
+        self._file.close()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
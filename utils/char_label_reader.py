@@ -1,6 +1,8 @@
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 
-from constants import CHAR_LABEL_SEPARATOR
+from constants import CHAR_LABEL_SEPARATOR, SPAN_LABEL_FILE_EXTENSION
+from utils.compression import iter_lines, strip_compression_extension
+from utils.span_label_reader import SpanLabelReader
 
 
 class CharLabelReader:
@@ -17,22 +19,34 @@ class CharLabelReader:
 
     @staticmethod
     def from_file(path: str):
-        with open(path, "r") as f:
-            lines = f.readlines()
         addresses, labels = [], []
-        for i, line in enumerate(lines):
+        for address, label in CharLabelReader.iter_file(path):
+            addresses.append(address)
+            labels.append(label)
+        return CharLabelReader(addresses, labels)
+
+    @staticmethod
+    def iter_file(path: str) -> Iterator[Tuple[str, List[str]]]:
+        """
+        Yield (address, char labels) one by one without loading the whole file, which may be compressed.
+        """
+        address = None
+        for i, line in enumerate(iter_lines(path)):
             if i % 3 == 0:
-                addresses.append(line.strip())
+                address = line.strip()
             elif i % 3 == 1:
                 label = line.strip().split(CHAR_LABEL_SEPARATOR)
-                assert len(addresses[-1]) == len(label), \
+                assert len(address) == len(label), \
                     f"Address and char label length should be the same!\n" \
-                    f"  Address: {addresses[-1]} with length {len(addresses[-1])}\n" \
+                    f"  Address: {address} with length {len(address)}\n" \
                     f"  Label: {label} with length {len(label)}."
-                labels.append(label)
-        return CharLabelReader(addresses, labels)
-
-
-
+                yield address, label
 
 
+def iter_char_label_records(path: str) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Yield (address, char labels) from either text or span-based char label file.
+    """
+    if strip_compression_extension(path).endswith(SPAN_LABEL_FILE_EXTENSION):
+        return iter(SpanLabelReader(path))
+    return CharLabelReader.iter_file(path)
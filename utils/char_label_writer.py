@@ -1,20 +1,19 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from constants import CHAR_LABEL_SEPARATOR
+from utils.buffered_writer import BufferedFileWriter
+from utils.instrumentation import timed
 
 
-class CharLabelWriter:
+class CharLabelWriter(BufferedFileWriter):
 
-    def __init__(self, path: str):
-        self._path = path
-        # Clean up file
-        with open(self._path, "w") as f:
-            f.write("")
+    def __init__(self, path: str, append: bool = False, flush_every: int = 1, flush_interval: Optional[float] = None,
+                 fsync: bool = False):
+        super().__init__(path, append=append, flush_every=flush_every, flush_interval=flush_interval, fsync=fsync)
 
+    @timed("write_char_label")
     def append(self, address: str, labels: List[str]):
         assert len(address) == len(labels),\
             f"Cannot write row whose address length and label length don't match!\n  Address: {address}  Labels: {labels}"
-        with open(self._path, "a") as f:
-            f.write(address + "\n")
-            f.write(CHAR_LABEL_SEPARATOR.join(labels) + "\n")
-            f.write("\n")
+        self._write(address + "\n" + CHAR_LABEL_SEPARATOR.join(labels) + "\n\n")
+        self._end_record()
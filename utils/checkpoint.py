@@ -0,0 +1,147 @@
+import json
+import os
+from typing import Callable, List, Optional
+
+from constants import SPAN_LABEL_FILE_EXTENSION
+from utils.instrumentation import timed
+from utils.shard_leases import shard_file_id
+
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+SESSION_SUFFIX = ".session.json"
+LABELLED_LINES_PER_RECORD = 1
+CHAR_LABEL_LINES_PER_RECORD = 3
+SPAN_LABEL_LINES_PER_RECORD = 1
+
+
+class Checkpoint:
+    """
+    Manifest of an annotation session. All records before next_index are stored in the output files,
+    which end at labelled_offset and char_label_offset bytes respectively.
+    With group_duplicates, next_index counts groups of duplicate addresses instead of rows, and with
+    queue_block_size, it counts items in order of the uncertainty queue.
+    """
+
+    def __init__(self, input_file: str, labelled_file: str, char_label_file: str, next_index: int = 0,
+                 labelled_offset: int = 0, char_label_offset: int = 0, last_address: Optional[str] = None,
+                 group_duplicates: bool = False, queue_block_size: Optional[int] = None,
+                 auto_accept: Optional[float] = None):
+        self.input_file = input_file
+        self.labelled_file = labelled_file
+        self.char_label_file = char_label_file
+        self.next_index = next_index
+        self.labelled_offset = labelled_offset
+        self.char_label_offset = char_label_offset
+        self.last_address = last_address
+        self.group_duplicates = group_duplicates
+        self.queue_block_size = queue_block_size
+        self.auto_accept = auto_accept
+
+    @timed("checkpoint")
+    def save(self, path: str):
+        # Write to temporary file first not to break the manifest on crash
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.__dict__, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def save_session(self):
+        """
+        Save the input of the output files next to them. The checkpoint is per input and replaced by a new session,
+        so this is what tells the input of older sessions.
+        """
+        with open(self.labelled_file + SESSION_SUFFIX, "w") as f:
+            json.dump({"input_file": self.input_file, "labelled_file": self.labelled_file,
+                       "char_label_file": self.char_label_file}, f, ensure_ascii=False)
+
+    def repair(self, labelled_header_size: int, num_records_of: Callable[[int], int] = lambda index: 1):
+        """
+        Make output files consistent with the checkpoint. Complete records written after the checkpoint are kept
+        as long as both files have all records of the index (num_records_of(index) records),
+        and anything else after them is truncated.
+        """
+        if os.path.getsize(self.labelled_file) < self.labelled_offset or \
+                os.path.getsize(self.char_label_file) < self.char_label_offset:
+            # Data lost after the checkpoint was saved (e.g. OS crash without fsync). Count records from the beginning.
+            print("Output files are shorter than the checkpoint. Scanning them from the beginning.")
+            self.next_index, self.labelled_offset = 0, labelled_header_size
+            self.char_label_offset = _char_label_header_size(self.char_label_file)
+
+        labelled_ends = _scan_record_ends(self.labelled_file, self.labelled_offset, LABELLED_LINES_PER_RECORD)
+        if self.char_label_file.endswith(SPAN_LABEL_FILE_EXTENSION):
+            char_label_ends = _scan_record_ends(self.char_label_file, self.char_label_offset,
+                                                SPAN_LABEL_LINES_PER_RECORD, is_json=True)
+        else:
+            char_label_ends = _scan_record_ends(self.char_label_file, self.char_label_offset,
+                                                CHAR_LABEL_LINES_PER_RECORD)
+        num_complete = min(len(labelled_ends), len(char_label_ends))
+        num_records = 0
+        while num_records + num_records_of(self.next_index) <= num_complete:
+            num_records += num_records_of(self.next_index)
+            self.next_index += 1
+        if num_records > 0:
+            self.labelled_offset = labelled_ends[num_records - 1]
+            self.char_label_offset = char_label_ends[num_records - 1]
+            self.last_address = None
+
+        for path, offset in ((self.labelled_file, self.labelled_offset), (self.char_label_file, self.char_label_offset)):
+            if os.path.getsize(path) > offset:
+                print(f"Truncated incomplete record at the end of {path}.")
+                with open(path, "rb+") as f:
+                    f.truncate(offset)
+
+    @staticmethod
+    def load(path: str) -> Optional["Checkpoint"]:
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return Checkpoint(**json.load(f))
+
+    @staticmethod
+    def from_outputs(input_file: str, labelled_file: str, char_label_file: str, labelled_header_size: int,
+                     group_duplicates: bool = False, queue_block_size: Optional[int] = None,
+                     auto_accept: Optional[float] = None) -> "Checkpoint":
+        # Checkpoint pointing at the beginning of existing outputs. Records are counted by repair().
+        return Checkpoint(input_file=input_file, labelled_file=labelled_file, char_label_file=char_label_file,
+                          labelled_offset=labelled_header_size,
+                          char_label_offset=_char_label_header_size(char_label_file),
+                          group_duplicates=group_duplicates, queue_block_size=queue_block_size,
+                          auto_accept=auto_accept)
+
+    @staticmethod
+    def path_for(output_dir: str, input_path: str, shard: Optional[int] = None) -> str:
+        if shard is not None:
+            return os.path.join(output_dir, shard_file_id(input_path, shard) + CHECKPOINT_SUFFIX)
+        return os.path.join(output_dir, os.path.basename(input_path) + CHECKPOINT_SUFFIX)
+
+
+def _char_label_header_size(path: str) -> int:
+    # Span-based char label file starts with a line of label vocabulary
+    if not path.endswith(SPAN_LABEL_FILE_EXTENSION):
+        return 0
+    with open(path, "rb") as f:
+        return len(f.readline())
+
+
+def _scan_record_ends(path: str, offset: int, lines_per_record: int, is_json: bool = False) -> List[int]:
+    # End offsets of complete records after the offset
+    record_ends = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        position = offset
+        num_lines = 0
+        for line in f:
+            if not line.endswith(b"\n") or (is_json and not _is_json(line)):
+                break
+            position += len(line)
+            num_lines += 1
+            if num_lines % lines_per_record == 0:
+                record_ends.append(position)
+    return record_ends
+
+
+def _is_json(line: bytes) -> bool:
+    try:
+        json.loads(line)
+        return True
+    except ValueError:
+        return False
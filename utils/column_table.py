@@ -0,0 +1,87 @@
+from array import array
+from typing import Dict, List
+
+# A column stays dictionary-encoded while it has at most this ratio of unique values to rows
+MAX_UNIQUE_RATIO = 0.25
+# Ratio is not checked for first rows, where most values are unique anyway
+MIN_ROWS_TO_CHECK = 1024
+
+
+class _DictionaryColumn:
+    # Each distinct value is stored once and rows keep its code
+
+    def __init__(self):
+        self.values: List[str] = []
+        self._codes_of: Dict[str, int] = {}
+        self.codes = array("I")
+
+    def append(self, value: str):
+        code = self._codes_of.get(value)
+        if code is None:
+            code = self._codes_of[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __getitem__(self, index: int) -> str:
+        return self.values[self.codes[index]]
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class _BlobColumn:
+    # Values are concatenated as UTF-8, and decoded only when a row is read
+
+    def __init__(self):
+        self._data = bytearray()
+        self._offsets = array("Q", [0])
+
+    def append(self, value: str):
+        self._data += value.encode("utf-8")
+        self._offsets.append(len(self._data))
+
+    def __getitem__(self, index: int) -> str:
+        return self._data[self._offsets[index]:self._offsets[index + 1]].decode("utf-8")
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    @staticmethod
+    def from_column(column: _DictionaryColumn) -> "_BlobColumn":
+        blob_column = _BlobColumn()
+        for code in column.codes:
+            blob_column.append(column.values[code])
+        return blob_column
+
+
+class ColumnTable:
+    """
+    Rows stored as one array per column instead of one dict per row. Columns with few distinct values such as
+    prefecture are dictionary-encoded, and the others such as address are kept as UTF-8 bytes.
+    Reading a row builds a new dict, so callers can add keys to it.
+    """
+
+    def __init__(self, keys: List[str]):
+        self._keys = keys
+        self._columns = [_DictionaryColumn() for _ in keys]
+        self._num_rows = 0
+
+    def append(self, values: List[str]):
+        assert len(values) == len(self._keys), f"Row doesn't match columns {self._keys}: {values}"
+        for column, value in zip(self._columns, values):
+            column.append(value)
+        self._num_rows += 1
+        if self._num_rows >= MIN_ROWS_TO_CHECK:
+            for i, column in enumerate(self._columns):
+                if isinstance(column, _DictionaryColumn) and len(column.values) > MAX_UNIQUE_RATIO * self._num_rows:
+                    self._columns[i] = _BlobColumn.from_column(column)
+
+    def __getitem__(self, index: int) -> Dict[str, str]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Row index out of range: {index}")
+        return {key: column[index] for key, column in zip(self._keys, self._columns)}
+
+    def __len__(self):
+        return self._num_rows
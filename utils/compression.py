@@ -0,0 +1,177 @@
+import bz2
+import gzip
+import io
+import lzma
+from typing import Any, Callable, Iterator, NamedTuple, Optional, Tuple
+import zlib
+
+# Extension -> (module, magic bytes at the beginning of the file, factory of a decompressor of one stream)
+COMPRESSIONS = {
+    ".gz": (gzip, b"\x1f\x8b", lambda: zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)),
+    ".bz2": (bz2, b"BZh", bz2.BZ2Decompressor),
+    ".xz": (lzma, b"\xfd7zXZ\x00", lzma.LZMADecompressor),
+}
+CHUNK_SIZE = 1 << 16
+
+
+class Checkpoint(NamedTuple):
+    # Position in the compressed file to resume decompressing from, a copy of the decompressor in the middle of a
+    # stream or None at the start of one, and the beginning of the line decompressed before the position
+    position: int
+    decompressor: Any
+    partial_line: bytes
+
+
+START_CHECKPOINT = Checkpoint(0, None, b"")
+
+
+def compression_of_extension(path: str) -> Optional[str]:
+    for extension in COMPRESSIONS:
+        if path.endswith(extension):
+            return extension
+    return None
+
+
+def detect_compression(path: str) -> Optional[str]:
+    """
+    Return the extension of the compression of the file, detected by its extension or its first bytes.
+    """
+    compression = compression_of_extension(path)
+    if compression is not None:
+        return compression
+    try:
+        with open(path, "rb") as f:
+            head = f.read(6)
+    except OSError:
+        return None
+    for extension, (_, magic, _) in COMPRESSIONS.items():
+        if head.startswith(magic):
+            return extension
+    return None
+
+
+def strip_compression_extension(path: str) -> str:
+    compression = compression_of_extension(path)
+    return path[:-len(compression)] if compression is not None else path
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    # Each call makes an independent stream. Concatenated streams are read as one file by all of the formats.
+    return COMPRESSIONS[compression][0].compress(data)
+
+
+def scan_streams(path: str, compression: str) -> Tuple[int, int]:
+    """
+    Return the size of the complete compressed streams at the beginning of the file, and their decompressed size.
+    Bytes after them are a stream cut by a crash while writing.
+    """
+    new_decompressor = COMPRESSIONS[compression][2]
+    complete_size, decompressed_size = 0, 0
+    consumed, stream_decompressed_size = 0, 0
+    decompressor = None
+    data = b""
+    with open(path, "rb") as f:
+        while True:
+            if not data:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    return complete_size, decompressed_size
+            if decompressor is None:
+                decompressor = new_decompressor()
+            try:
+                stream_decompressed_size += len(decompressor.decompress(data))
+            except (OSError, EOFError, zlib.error, lzma.LZMAError):
+                # Broken stream
+                return complete_size, decompressed_size
+            if decompressor.eof:
+                unused_data = decompressor.unused_data
+                consumed += len(data) - len(unused_data)
+                complete_size, decompressed_size = consumed, decompressed_size + stream_decompressed_size
+                decompressor, stream_decompressed_size, data = None, 0, unused_data
+            else:
+                consumed += len(data)
+                data = b""
+
+
+def iter_lines_from_checkpoint(path: str, compression: str, checkpoint: Checkpoint = START_CHECKPOINT,
+                               checkpoint_interval: int = 0,
+                               on_checkpoint: Optional[Callable[[Checkpoint], None]] = None) -> Iterator[bytes]:
+    """
+    Yield lines of a compressed file without line endings, decompressing it from the checkpoint.
+    If on_checkpoint is given, it is called with a checkpoint of the line to be yielded next, at the first chance
+    after every checkpoint_interval lines. Gzip decompressors can be copied, so there is a chance after every chunk.
+    Bz2 and xz ones cannot, so there is a chance only at the start of each stream, such as the blocks written by
+    BufferedFileWriter.
+    """
+    new_decompressor = COMPRESSIONS[compression][2]
+    position, decompressor, partial_line = checkpoint
+    if decompressor is not None:
+        # The checkpoint can be resumed from again
+        decompressor = decompressor.copy()
+    num_lines = 0
+    data = b""
+    with open(path, "rb") as f:
+        f.seek(position)
+        while True:
+            if on_checkpoint is not None and num_lines >= checkpoint_interval and \
+                    (decompressor is None or (not data and hasattr(decompressor, "copy"))):
+                on_checkpoint(Checkpoint(position, decompressor and decompressor.copy(), partial_line))
+                num_lines = 0
+            if not data:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+            if decompressor is None:
+                decompressor = new_decompressor()
+            try:
+                output = decompressor.decompress(data)
+            except (OSError, EOFError, zlib.error, lzma.LZMAError):
+                print(f"A block of {path} is broken. Lines after it are lost.")
+                return
+            if decompressor.eof:
+                unused_data = decompressor.unused_data
+                position += len(data) - len(unused_data)
+                decompressor, data = None, unused_data
+            else:
+                position += len(data)
+                data = b""
+            lines = (partial_line + output).split(b"\n")
+            partial_line = lines.pop()
+            yield from lines
+            num_lines += len(lines)
+    if decompressor is not None:
+        print(f"The last block of {path} is cut in the middle. Lines after the cut are lost.")
+    elif partial_line:
+        yield partial_line
+
+
+def open_binary(path: str):
+    """
+    Open the file for reading, decompressing it on the fly if it is compressed.
+    """
+    compression = detect_compression(path)
+    if compression is None:
+        return open(path, "rb")
+    return COMPRESSIONS[compression][0].open(path, "rb")
+
+
+def iter_lines(path: str) -> Iterator[str]:
+    """
+    Yield lines of a plain or compressed text file in bounded memory. If the last block of a compressed file is
+    cut by a crash while writing, lines decompressed from it so far are yielded except for a partial last line.
+    """
+    with io.TextIOWrapper(open_binary(path), encoding="utf-8", newline="") as f:
+        pending = None
+        try:
+            for line in f:
+                # A line is yielded once the following one is read, since a cut block can end in the middle of a line
+                if pending is not None:
+                    yield pending
+                pending = line
+        except EOFError:
+            print(f"The last block of {path} is cut in the middle. Lines after the cut are lost.")
+            if pending is not None and pending.endswith("\n"):
+                yield pending
+            return
+        if pending is not None:
+            yield pending
@@ -1,15 +1,25 @@
-from typing import Dict, List
+from typing import Dict, List, Union
+
+from utils.column_table import ColumnTable
+from utils.compression import detect_compression, iter_lines
+from utils.instrumentation import timed
+from utils.streaming_csv_reader import StreamingCSVReader
 
 
 class CSVReader:
+    """
+    Reader which loads all rows in memory, as a list of dicts or a ColumnTable.
+    Compressed files are read by StreamingCSVReader instead, in bounded memory.
+    """
 
-    def __init__(self, header: List[str], contents: List[Dict[str, str]]):
+    def __init__(self, header: List[str], contents: Union[List[Dict[str, str]], ColumnTable]):
         self._header = header
         self._contents = contents
 
     def get_header(self) -> List[str]:
         return self._header
 
+    @timed("csv_parse")
     def read_record(self, index: int) -> Dict[str, str]:
         return self._contents[index]
 
@@ -17,21 +27,23 @@ class CSVReader:
         return len(self._contents)
 
     @staticmethod
-    def from_file(path: str, sep: str, header=None):
-        with open(path, "r") as f:
-            lines = f.readlines()
-
-            if header is None:
-                header = [col for col in lines[0].strip().split(sep)]
-                lines = lines[1:]
-
-            contents = []
-            for line in lines:
-                values = line.split(sep)
-                assert len(header) == len(values), \
-                    f"Malformed line doesn't match header schema!\nHeader: {header}\nLine: {line}"
-                content = {label.strip(): token.strip() for label, token in zip(header, values)}
-                contents.append(content)
+    def from_file(path: str, sep: str, header=None, columnar: bool = True):
+        if detect_compression(path) is not None:
+            return StreamingCSVReader.from_file(path, sep, header=header)
+        lines = iter_lines(path)
+        if header is None:
+            header = [col for col in next(lines).strip().split(sep)]
+
+        keys = [label.strip() for label in header]
+        contents = ColumnTable(keys) if columnar else []
+        for line in lines:
+            values = line.split(sep)
+            assert len(header) == len(values), \
+                f"Malformed line doesn't match header schema!\nHeader: {header}\nLine: {line}"
+            if columnar:
+                contents.append([token.strip() for token in values])
+            else:
+                contents.append({key: token.strip() for key, token in zip(keys, values)})
         return CSVReader(header, contents)
 
 
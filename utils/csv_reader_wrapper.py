@@ -1,36 +1,170 @@
-from typing import Dict, List
+from itertools import islice
+import threading
+from typing import Dict, Iterable, List, Optional, Union
 
-from parser.crf_parser import CRFParser
+from parser.registry import DEFAULT_PARSER, NO_PARSER, ParserLoader
 from utils.csv_reader import CSVReader
+from utils.estimator_prefetcher import EstimatorPrefetcher
+from utils.estimator_worker import EstimatorUnavailable, EstimatorWorker
+from utils.instrumentation import timed
+from utils.lazy_csv_reader import LazyCSVReader
+from utils.parse_cache import ParseCache, parser_identity
+from utils.streaming_csv_reader import StreamingCSVReader
 
 
 class CSVReaderWrapperWithWeakEstimator:
+    """
+    Reads records with labels estimated by the parser of parser_name (see parser.registry).
+    The parser is loaded on a background thread. Callers not to wait for it read with estimate=False until
+    estimator_ready(). With estimator_timeout, the parser runs in a separate process instead (see EstimatorWorker),
+    and records whose estimation fails or takes longer than estimator_timeout seconds are read without estimation.
+    """
 
-    def __init__(self, csv_reader: CSVReader):
+    def __init__(self, csv_reader: Union[CSVReader, LazyCSVReader, StreamingCSVReader], prefetch_window: int = 0,
+                 prefetch_workers: int = 1, parser_name: str = DEFAULT_PARSER, parse_cache_path: Optional[str] = None,
+                 parse_cache_size: int = 1000000, estimator_timeout: Optional[float] = None):
         self._csv_reader = csv_reader
-        self._estimator = CRFParser()
+        # Without estimator, predicted columns must be already in the file (see preannotate.py)
+        use_estimator = parser_name != NO_PARSER
+        self._parser_loader = None
+        self._worker = None
+        if use_estimator and estimator_timeout is not None:
+            self._worker = EstimatorWorker(parser_name, timeout=estimator_timeout)
+        elif use_estimator:
+            self._parser_loader = ParserLoader(parser_name)
+        self._estimator_timeout = estimator_timeout
+        self._last_estimator_error = None
+        # One parser is shared by prefetch threads, since each instance may hold a model
+        self._estimator_lock = threading.Lock()
+
+        # Opened once the parser is loaded, since entries are keyed by the parser identity
+        self._parse_cache = None
+        self._parse_cache_path = parse_cache_path if use_estimator else None
+        self._parse_cache_size = parse_cache_size
+        self._parse_cache_lock = threading.Lock()
+
+        self._prefetch_window = prefetch_window
+        self._prefetcher = None
+        if use_estimator and prefetch_window > 0:
+            self._prefetcher = EstimatorPrefetcher(self._estimate,
+                                                   num_workers=prefetch_workers,
+                                                   capacity=2 * prefetch_window)
 
     def get_header(self) -> List[str]:
         return self._csv_reader.get_header()
 
-    def read_record(self, index: int, estimate: bool = True) -> Dict[str, str]:
+    def estimator_ready(self) -> bool:
+        if self._worker is not None:
+            return self._worker.ready() or not self._worker.healthy()
+        return self._parser_loader is None or self._parser_loader.ready()
+
+    def estimator_load_seconds(self) -> Optional[float]:
+        if self._worker is not None:
+            return self._worker.load_seconds
+        return self._parser_loader.load_seconds if self._parser_loader is not None else None
+
+    @timed("read_record")
+    def read_record(self, index: int, estimate: bool = True,
+                    upcoming: Optional[Iterable[int]] = None) -> Dict[str, str]:
+        """
+        Read the record with estimated labels, waiting for the parser to be loaded. Estimation for indices in
+        upcoming, or following indices if not given, starts in background.
+        """
         record = self._csv_reader.read_record(index)
-        if estimate:
-            parsed_result = {k.lower(): v for k, v in self._estimator.parse(record["address"]).items()}
+        if estimate and (self._parser_loader is not None or self._worker is not None):
+            try:
+                # A timed-out prefetch is not parsed again, so a read waits at most about estimator_timeout
+                parsed_result = self._prefetcher.get(index, timeout=self._estimator_timeout) \
+                    if self._prefetcher is not None else None
+                if parsed_result is None:
+                    parsed_result = self._estimate(record["address"])
+            except EstimatorUnavailable as e:
+                # Estimator is slow or broken. Record is labelled from scratch.
+                if str(e) != self._last_estimator_error:
+                    print(f"Estimation for record {index} is skipped: {e}")
+                self._last_estimator_error = str(e)
+                parsed_result = {}
             for key in parsed_result:
                 if key not in record:  # Use existing one
-                    record[key] = parsed_result[key.lower()]
+                    record[key] = parsed_result[key]
+            self._prefetch(upcoming if upcoming is not None else range(index + 1, len(self)))
         return record
 
-    def __len__(self):
-        return len(self._csv_reader)
+    def _prefetch(self, upcoming: Iterable[int]):
+        if self._prefetcher is None:
+            return
+        self._prefetcher.schedule((i, self._csv_reader.read_record(i)["address"])
+                                  for i in islice(upcoming, self._prefetch_window))
 
-    @staticmethod
-    def from_file(path: str, sep: str, header=None):
-        csv_reader = CSVReader.from_file(path=path, sep=sep, header=header)
-        return CSVReaderWrapperWithWeakEstimator(csv_reader)
+    @timed("estimate")
+    def _estimate(self, address: str) -> Dict[str, str]:
+        parse_cache = self._get_parse_cache()
+        if parse_cache is not None:
+            return parse_cache.get_or_parse(address, self._parse)
+        return self._parse(address)
 
+    def _get_parse_cache(self) -> Optional[ParseCache]:
+        if self._parse_cache_path is None:
+            return None
+        with self._parse_cache_lock:
+            if self._parse_cache is None:
+                if self._worker is not None:
+                    # Not loaded yet. Parsing fails with the reason.
+                    if self._worker.parser_id is None:
+                        return None
+                    parser_id = self._worker.parser_id
+                else:
+                    parser_id = parser_identity(self._loaded_parser())
+                self._parse_cache = ParseCache.open(self._parse_cache_path, parser_id,
+                                                    max_entries=self._parse_cache_size)
+            return self._parse_cache
 
+    def _parse(self, address: str) -> Dict[str, str]:
+        if self._worker is not None:
+            return self._worker.parse(address)
+        estimator = self._loaded_parser()
+        if getattr(estimator, "thread_safe", False):
+            parsed_result = estimator.parse(address)
+        else:
+            with self._estimator_lock:
+                parsed_result = estimator.parse(address)
+        return {k.lower(): v for k, v in parsed_result.items()}
 
+    def _loaded_parser(self):
+        # Failure to load the parser is handled as unavailable estimator, not to stop the annotation
+        try:
+            return self._parser_loader.get()
+        except RuntimeError as e:
+            raise EstimatorUnavailable(f"{e}: {e.__cause__!r}") from e
 
+    def close(self):
+        if self._prefetcher is not None:
+            self._prefetcher.shutdown()
+            self._prefetcher = None
+        if self._worker is not None:
+            self._worker.close()
+            self._worker = None
+        with self._parse_cache_lock:
+            if self._parse_cache is not None:
+                self._parse_cache.close()
+                self._parse_cache = None
+            # Not to open the cache again after close
+            self._parse_cache_path = None
+        if hasattr(self._csv_reader, "close"):
+            self._csv_reader.close()
 
+    def __len__(self):
+        return len(self._csv_reader)
+
+    @staticmethod
+    def from_file(path: str, sep: str, header=None, prefetch_window: int = 0, prefetch_workers: int = 1,
+                  parser_name: str = DEFAULT_PARSER, parse_cache_path: Optional[str] = None,
+                  parse_cache_size: int = 1000000, estimator_timeout: Optional[float] = None):
+        csv_reader = LazyCSVReader.from_file(path=path, sep=sep, header=header)
+        return CSVReaderWrapperWithWeakEstimator(csv_reader,
+                                                 prefetch_window=prefetch_window,
+                                                 prefetch_workers=prefetch_workers,
+                                                 parser_name=parser_name,
+                                                 parse_cache_path=parse_cache_path,
+                                                 parse_cache_size=parse_cache_size,
+                                                 estimator_timeout=estimator_timeout)
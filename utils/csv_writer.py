@@ -1,29 +1,45 @@
 import csv
-from typing import Dict, List
+import io
+from typing import Dict, List, Optional
 
+from utils.buffered_writer import BufferedFileWriter
+from utils.instrumentation import timed
 
-class CSVWriter:
 
-    def __init__(self, path: str, sep: str, header=None):
-        self._path = path
+class CSVWriter(BufferedFileWriter):
+
+    def __init__(self, path: str, sep: str, header=None, append: bool = False, flush_every: int = 1,
+                 flush_interval: Optional[float] = None, fsync: bool = False):
+        super().__init__(path, append=append, flush_every=flush_every, flush_interval=flush_interval, fsync=fsync)
         self._sep = sep
         self._header = header
 
-        with open(self._path, "w") as f:
-            writer = csv.DictWriter(f, fieldnames=self._header, delimiter=self._sep)
-            if self._header is not None:
-                writer.writeheader()
+        # Rows are formatted into this string buffer and then moved to the write buffer
+        self._row_buffer = io.StringIO()
+        self._list_writer = csv.writer(self._row_buffer, delimiter=self._sep)
+        self._dict_writer = csv.DictWriter(self._row_buffer, fieldnames=self._header, delimiter=self._sep)
+        if self._header is not None and not append:
+            self._dict_writer.writeheader()
+            self._move_row()
+            self.flush()
+
+    def _move_row(self):
+        self._write(self._row_buffer.getvalue())
+        self._row_buffer.seek(0)
+        self._row_buffer.truncate()
 
+    @timed("write_labelled")
     def append_list(self, _list: List[str]):
         assert len(self._header) == len(_list),\
             f"Cannot write row which doesn't match header schema!\n  Header: {self._header}  Row: {_list}"
-        with open(self._path, "a") as f:
-            writer = csv.writer(f, delimiter=self._sep)
-            writer.writerow(_list)
+        self._list_writer.writerow(_list)
+        self._move_row()
+        self._end_record()
 
+    @timed("write_labelled")
     def append_dict(self, _dict: Dict[str, str]):
         assert set(self._header) == set(_dict.keys()),\
             f"Cannot write row which doesn't match header schema!\n  Header: {self._header}  Row: {_dict}"
-        with open(self._path, "a") as f:
-            writer = csv.DictWriter(f, fieldnames=self._header, delimiter=self._sep)
-            writer.writerow(_dict)
+        self._dict_writer.writerow(_dict)
+        self._move_row()
+        self._end_record()
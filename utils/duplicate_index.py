@@ -0,0 +1,36 @@
+from typing import Dict, Iterable, List
+
+from utils.normalize import normalize_address
+
+
+class DuplicateIndex:
+    """
+    Groups of row indices whose addresses are the same after normalization, in order of their first occurrence.
+    """
+
+    def __init__(self, groups: List[List[int]], num_rows: int):
+        self.groups = groups
+        self.num_rows = num_rows
+
+    def __len__(self):
+        return len(self.groups)
+
+    def report(self) -> str:
+        num_duplicates = self.num_rows - len(self.groups)
+        ratio = num_duplicates / self.num_rows if self.num_rows > 0 else 0.0
+        return f"{self.num_rows} rows, {len(self.groups)} unique addresses ({ratio:.1%} duplicates)."
+
+    @staticmethod
+    def build(addresses: Iterable[str]) -> "DuplicateIndex":
+        normalized_to_group: Dict[str, List[int]] = {}
+        groups = []
+        num_rows = 0
+        for i, address in enumerate(addresses):
+            key = normalize_address(address)
+            group = normalized_to_group.get(key)
+            if group is None:
+                group = normalized_to_group[key] = []
+                groups.append(group)
+            group.append(i)
+            num_rows += 1
+        return DuplicateIndex(groups, num_rows)
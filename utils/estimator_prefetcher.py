@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError
+from typing import Callable, Dict, Iterable, Optional
+
+from utils.estimator_worker import EstimatorUnavailable
+
+
+class EstimatorPrefetcher:
+    """
+    Runs the estimator for upcoming records in a worker pool and keeps the results in a bounded cache.
+    """
+
+    def __init__(self, estimate: Callable[[str], Dict[str, str]], num_workers: int = 1, capacity: int = 16):
+        self._estimate = estimate
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="estimator")
+        self._capacity = capacity
+        self._futures: "OrderedDict[int, Future]" = OrderedDict()
+
+    def schedule(self, items: Iterable):
+        """
+        Submit (index, address) pairs which are not scheduled yet.
+        """
+        for index, address in items:
+            if index in self._futures:
+                self._futures.move_to_end(index)
+                continue
+            self._futures[index] = self._executor.submit(self._estimate, address)
+            while len(self._futures) > self._capacity:
+                _, future = self._futures.popitem(last=False)
+                future.cancel()
+
+    def get(self, index: int, timeout: Optional[float] = None) -> Optional[Dict[str, str]]:
+        """
+        Return the prefetched result for the index, or None if it is missing, not started yet or failed.
+        Raises EstimatorUnavailable if the estimator is unavailable or the result is not ready within timeout,
+        since parsing again would not be faster.
+        """
+        future = self._futures.pop(index, None)
+        if future is None:
+            return None
+        # Not started yet: parsing synchronously is faster than waiting for the queue
+        if future.cancel():
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except CancelledError:
+            return None
+        except TimeoutError:
+            raise EstimatorUnavailable(f"Prefetched estimation for record {index} took more than {timeout:.1f}s") \
+                from None
+        except EstimatorUnavailable:
+            raise
+        except Exception as e:
+            print(f"Prefetched estimation for record {index} failed, fallback to synchronous parsing: {e}")
+            return None
+
+    def shutdown(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
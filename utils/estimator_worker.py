@@ -0,0 +1,169 @@
+from concurrent.futures import Future, TimeoutError
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from parser.registry import load_parser_class
+from utils.parse_cache import parser_identity
+
+# Interval to check whether the worker process is alive
+POLL_SECONDS = 0.5
+
+
+class EstimatorUnavailable(Exception):
+    """
+    Raised when the estimator worker is loading, restarting or unhealthy, or a call timed out.
+    """
+
+
+def _serve(parser_name: str, requests, responses):
+    # Runs in the worker process
+    start = time.perf_counter()
+    parser = load_parser_class(parser_name)()
+    responses.put(("ready", parser_identity(parser), time.perf_counter() - start))
+    while True:
+        batch = requests.get()
+        if batch is None:
+            return
+        results = []
+        for request_id, address in batch:
+            try:
+                results.append((request_id, {k.lower(): v for k, v in parser.parse(address).items()}, None))
+            except Exception as e:
+                results.append((request_id, None, repr(e)))
+        responses.put(("results", results))
+
+
+class EstimatorWorker:
+    """
+    Runs the parser in a separate process, so that a hanging or crashing parser doesn't stop the annotation.
+    Concurrent parse() calls are sent to the worker in one batch. A call which takes longer than timeout,
+    or a crash of the worker, restarts the worker, and after max_restarts consecutive failures the worker is
+    regarded as unhealthy and parse() fails immediately.
+    """
+
+    def __init__(self, parser_name: str, timeout: float = 2.0, max_restarts: int = 3):
+        self._parser_name = parser_name
+        self._timeout = timeout
+        self._max_restarts = max_restarts
+        # Not to fork threads of the parent process
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._futures: Dict[int, Future] = {}
+        self._next_request_id = 0
+        self._outbox: "queue.Queue[Optional[Tuple[int, str]]]" = queue.Queue()
+        self._num_failures = 0
+        self._closed = False
+
+        self.parser_id: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self._ready = threading.Event()
+        self._start()
+        threading.Thread(target=self._dispatch, name="estimator-dispatch", daemon=True).start()
+
+    def _start(self):
+        self._ready.clear()
+        self._requests = self._context.Queue()
+        self._responses = self._context.Queue()
+        self._process = self._context.Process(target=_serve, args=(self._parser_name, self._requests, self._responses),
+                                              name=f"estimator-{self._parser_name}", daemon=True)
+        self._process.start()
+        threading.Thread(target=self._receive, args=(self._process, self._responses),
+                         name="estimator-receive", daemon=True).start()
+
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def healthy(self) -> bool:
+        return self._num_failures <= self._max_restarts
+
+    def parse(self, address: str) -> Dict[str, str]:
+        if not self.healthy():
+            raise EstimatorUnavailable(f"Estimator worker failed {self._num_failures} times in a row")
+        if not self.ready():
+            raise EstimatorUnavailable("Estimator worker is loading the parser")
+        process = self._process
+        future = Future()
+        with self._lock:
+            request_id = self._next_request_id
+            self._next_request_id += 1
+            self._futures[request_id] = future
+        self._outbox.put((request_id, address))
+        try:
+            return future.result(timeout=self._timeout)
+        except TimeoutError:
+            self._restart(process, f"parsing {address} took more than {self._timeout}s")
+            raise EstimatorUnavailable(f"Parsing {address} timed out") from None
+
+    def _dispatch(self):
+        # Send calls waiting at the same time as one batch
+        while True:
+            request = self._outbox.get()
+            if request is None:
+                return
+            batch = [request]
+            while True:
+                try:
+                    request = self._outbox.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    return
+                batch.append(request)
+            self._requests.put(batch)
+
+    def _receive(self, process, responses):
+        while True:
+            try:
+                message = responses.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if process is not self._process or self._closed:
+                    return
+                if not process.is_alive():
+                    self._restart(process, f"worker exited with code {process.exitcode}")
+                    return
+                continue
+            if message[0] == "ready":
+                _, self.parser_id, self.load_seconds = message
+                self._ready.set()
+                continue
+            self._num_failures = 0
+            for request_id, result, error in message[1]:
+                with self._lock:
+                    future = self._futures.pop(request_id, None)
+                if future is None:
+                    continue
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(EstimatorUnavailable(f"Parser raised {error}"))
+
+    def _restart(self, process, reason: str):
+        with self._lock:
+            # Already restarted by another call
+            if self._closed or process is not self._process:
+                return
+            self._num_failures += 1
+            # Calls sent to the dead worker are never answered
+            futures, self._futures = self._futures, {}
+            for future in futures.values():
+                future.set_exception(EstimatorUnavailable(reason))
+            if process.is_alive():
+                process.kill()
+            if not self.healthy():
+                print(f"Estimator worker is unhealthy ({reason}). Records are shown without estimation.")
+                return
+            print(f"Restarting estimator worker: {reason}.")
+            self._start()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self._outbox.put(None)
+        if self._process.is_alive():
+            self._requests.put(None)
+            self._process.join(timeout=POLL_SECONDS)
+            if self._process.is_alive():
+                self._process.kill()
@@ -0,0 +1,112 @@
+import atexit
+import csv
+import json
+import signal
+import time
+from typing import Dict, List, Optional
+
+# Checked on every call of instrumented functions, so that disabled instrumentation costs one global lookup
+_enabled = False
+_output_path: Optional[str] = None
+_histograms: Dict[str, "LatencyHistogram"] = {}
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with power-of-two buckets in microseconds. Bucket i counts latencies in [2^(i-1), 2^i) us.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+        self.buckets: List[int] = [0] * 40
+
+    def record(self, elapsed_ns: int):
+        self.count += 1
+        self.total_ns += elapsed_ns
+        if self.min_ns is None or elapsed_ns < self.min_ns:
+            self.min_ns = elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+        self.buckets[min((elapsed_ns // 1000).bit_length(), len(self.buckets) - 1)] += 1
+
+    def percentile_ms(self, p: float) -> float:
+        # Upper bound of the bucket which contains the percentile
+        threshold = self.count * p / 100
+        cumulative = 0
+        for i, n in enumerate(self.buckets):
+            cumulative += n
+            if cumulative >= threshold:
+                return min(2 ** i / 1000, self.max_ns / 1e6)
+        return self.max_ns / 1e6
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "total_ms": self.total_ns / 1e6,
+            "mean_ms": self.total_ns / 1e6 / self.count if self.count else 0.0,
+            "min_ms": (self.min_ns or 0) / 1e6,
+            "max_ms": self.max_ns / 1e6,
+            "p50_ms": self.percentile_ms(50),
+            "p90_ms": self.percentile_ms(90),
+            "p99_ms": self.percentile_ms(99),
+        }
+
+
+def timed(stage: str):
+    """
+    Record latency of the decorated function as the stage when instrumentation is enabled.
+    """
+    def _timed(func):
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter_ns() - start)
+        return wrapper
+    return _timed
+
+
+def record(stage: str, elapsed_ns: int):
+    histogram = _histograms.get(stage)
+    if histogram is None:
+        histogram = _histograms.setdefault(stage, LatencyHistogram())
+    histogram.record(elapsed_ns)
+
+
+def enable(output_path: str):
+    """
+    Start recording latencies. Histograms are written to output_path (.json or .csv) on exit and on SIGUSR1.
+    """
+    global _enabled, _output_path
+    _enabled = True
+    _output_path = output_path
+    atexit.register(dump)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
+
+
+def dump(path: Optional[str] = None):
+    path = path if path is not None else _output_path
+    if path is None:
+        return
+    histograms = sorted(_histograms.items())
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["stage", "count", "total_ms", "mean_ms", "min_ms", "max_ms", "p50_ms", "p90_ms", "p99_ms"])
+            for stage, histogram in histograms:
+                writer.writerow([stage, *histogram.summary().values()])
+    else:
+        result = {}
+        for stage, histogram in histograms:
+            buckets = {f"<{2 ** i}us": n for i, n in enumerate(histogram.buckets) if n > 0}
+            result[stage] = {**histogram.summary(), "buckets": buckets}
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+    print(f"Wrote latency histograms to {path}.")
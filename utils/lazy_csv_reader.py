@@ -0,0 +1,126 @@
+from array import array
+import mmap
+import os
+import struct
+from typing import Dict, List, Optional
+
+from utils.compression import detect_compression
+from utils.instrumentation import timed
+from utils.streaming_csv_reader import StreamingCSVReader
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"ADDRIDX1"
+# magic, size of the source file, mtime (ns) of the source file, whether the first line is a header
+INDEX_HEADER = struct.Struct("<8sQQQ")
+
+
+class LazyCSVReader:
+    """
+    Random-access reader which keeps the file memory-mapped and parses a row only when it is requested.
+    Byte offsets of rows are stored in "<path>.idx" so the file is scanned only once.
+    """
+
+    def __init__(self, path: str, sep: str, header: List[str], file, mm, offsets):
+        self._path = path
+        self._sep = sep
+        self._header = header
+        self._file = file
+        self._mm = mm
+        # offsets[i] is the start of row i, and offsets[-1] is the end of the last row
+        self._offsets = offsets
+
+    def get_header(self) -> List[str]:
+        return self._header
+
+    @timed("csv_parse")
+    def read_record(self, index: int) -> Dict[str, str]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Record index out of range: {index}")
+        line = self._mm[self._offsets[index]:self._offsets[index + 1]].decode("utf-8")
+        values = line.split(self._sep)
+        assert len(self._header) == len(values), \
+            f"Malformed line doesn't match header schema!\nHeader: {self._header}\nLine: {line}"
+        return {label.strip(): token.strip() for label, token in zip(self._header, values)}
+
+    def __len__(self):
+        return max(len(self._offsets) - 1, 0)
+
+    def close(self):
+        if isinstance(self._offsets, memoryview):
+            self._offsets.release()
+        if self._mm is not None:
+            self._mm.close()
+        self._file.close()
+
+    @staticmethod
+    def from_file(path: str, sep: str, header=None):
+        # Compressed files cannot be memory-mapped
+        if detect_compression(path) is not None:
+            return StreamingCSVReader.from_file(path, sep, header=header)
+        f = open(path, "rb")
+        stat = os.fstat(f.fileno())
+        if stat.st_size == 0:
+            return LazyCSVReader(path, sep, header or [], f, None, array("Q"))
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        has_header = header is None
+        if has_header:
+            end = mm.find(b"\n")
+            end = len(mm) if end < 0 else end
+            header = [col for col in mm[:end].decode("utf-8").strip().split(sep)]
+
+        offsets = _load_index(path, stat, has_header)
+        if offsets is None:
+            offsets = _build_index(mm, has_header)
+            _save_index(path, stat, has_header, offsets)
+        return LazyCSVReader(path, sep, header, f, mm, offsets)
+
+
+def _build_index(mm: mmap.mmap, skip_first_line: bool) -> array:
+    offsets = array("Q")
+    size = len(mm)
+    pos = 0
+    if skip_first_line:
+        pos = mm.find(b"\n") + 1 or size
+    while pos < size:
+        end = mm.find(b"\n", pos)
+        end = size if end < 0 else end
+        # Skip blank lines such as a trailing newline
+        if mm[pos:end].strip():
+            offsets.append(pos)
+            last_end = end
+        pos = end + 1
+    if offsets:
+        offsets.append(last_end)
+    return offsets
+
+
+def _load_index(path: str, stat: os.stat_result, has_header: bool) -> Optional[memoryview]:
+    try:
+        with open(path + INDEX_SUFFIX, "rb") as f:
+            index_mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(index_mm) < INDEX_HEADER.size:
+        index_mm.close()
+        return None
+    magic, size, mtime_ns, header_flag = INDEX_HEADER.unpack_from(index_mm)
+    if (magic, size, mtime_ns, header_flag) != (INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, int(has_header)):
+        # Stale index
+        index_mm.close()
+        return None
+    return memoryview(index_mm)[INDEX_HEADER.size:].cast("Q")
+
+
+def _save_index(path: str, stat: os.stat_result, has_header: bool, offsets: array):
+    tmp_path = path + INDEX_SUFFIX + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, int(has_header)))
+            offsets.tofile(f)
+        os.replace(tmp_path, path + INDEX_SUFFIX)
+    except OSError:
+        # Read-only directory etc. The index is just rebuilt next time.
+        pass
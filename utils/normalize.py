@@ -0,0 +1,23 @@
+import re
+import unicodedata
+
+# Hyphen-like characters used in block numbers, e.g. "1−2", "1‐2", "1－2"
+HYPHENS = "‐‑‒–—―−－﹣"
+_HYPHEN_TABLE = str.maketrans({hyphen: "-" for hyphen in HYPHENS})
+# Prolonged sound mark is a hyphen only between digits, e.g. "1ー2"
+_PROLONGED_SOUND_MARK_PATTERN = re.compile(r"(?<=[0-9])ー(?=[0-9])")
+
+
+def _normalize_char(char: str) -> str:
+    normalized = unicodedata.normalize("NFKC", char)
+    # Keep one char per char so that indices in normalized address are valid for the original one
+    return normalized if len(normalized) == 1 else char
+
+
+def normalize_address(address: str) -> str:
+    """
+    Normalize full-width / half-width variants and hyphen variants, e.g. "１２３ー４" -> "123-4".
+    The length of the address is preserved.
+    """
+    normalized = "".join(_normalize_char(char) for char in address.strip()).translate(_HYPHEN_TABLE)
+    return _PROLONGED_SOUND_MARK_PATTERN.sub("-", normalized)
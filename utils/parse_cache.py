@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from utils.normalize import normalize_address
+
+COMMIT_INTERVAL = 100
+# Part of the keys, so that entries in an older format are not read and are evicted eventually
+VALUE_FORMAT = 2
+
+
+def parser_identity(parser) -> str:
+    parser_class = type(parser)
+    version = getattr(parser, "version", None) or getattr(sys.modules.get(parser_class.__module__), "__version__", "")
+    return f"{parser_class.__module__}.{parser_class.__qualname__}:{version}"
+
+
+class ParseCache:
+    """
+    Persistent cache of parser results keyed by the normalized address and the parser identity.
+    Least recently used entries are evicted when the number of entries exceeds max_entries.
+    """
+
+    def __init__(self, path: str, parser_id: str, max_entries: int = 1000000):
+        self._path = path
+        self._parser_id = parser_id
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, last_used INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL)")
+        self._clock = self._conn.execute("SELECT COALESCE(MAX(last_used), 0) FROM entries").fetchone()[0]
+        self._num_entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        self._num_uncommitted = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.parse_seconds = 0.0
+
+    def _key(self, normalized_address: str) -> str:
+        return hashlib.sha1(f"{VALUE_FORMAT}\0{self._parser_id}\0{normalized_address}".encode("utf-8")).hexdigest()
+
+    def get_or_parse(self, address: str, parse: Callable[[str], Dict[str, str]]) -> Dict[str, str]:
+        normalized_address = normalize_address(address)
+        key = self._key(normalized_address)
+        cached = self._get(key)
+        if cached is not None:
+            return _denormalize(cached, address)
+
+        start = time.perf_counter()
+        parsed_result = parse(address)
+        parse_seconds = time.perf_counter() - start
+        starts = _value_starts(parsed_result, address, normalized_address)
+        self._put(key, {k: [normalize_address(v), starts[k]] for k, v in parsed_result.items()}, parse_seconds)
+        return parsed_result
+
+    def _get(self, key: str) -> Optional[Dict[str, List]]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.hits += 1
+            self._clock += 1
+            self._conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (self._clock, key))
+            self._maybe_commit()
+        return json.loads(row[0])
+
+    def _put(self, key: str, value: Dict[str, List], parse_seconds: float):
+        with self._lock:
+            self.misses += 1
+            self.parse_seconds += parse_seconds
+            self._clock += 1
+            # Another thread may have put the same key since _get(), and replacing it doesn't add an entry
+            exists = self._conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+            self._conn.execute("INSERT OR REPLACE INTO entries (key, value, last_used) VALUES (?, ?, ?)",
+                               (key, json.dumps(value, ensure_ascii=False), self._clock))
+            if not exists:
+                self._num_entries += 1
+            if self._num_entries > self._max_entries:
+                self._evict()
+            self._maybe_commit()
+
+    def _evict(self):
+        # Evict 10% at once to avoid running DELETE on every insertion
+        num_evict = self._num_entries - int(self._max_entries * 0.9)
+        self._conn.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used LIMIT ?)",
+                           (num_evict,))
+        self._num_entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _maybe_commit(self):
+        self._num_uncommitted += 1
+        if self._num_uncommitted >= COMMIT_INTERVAL:
+            self._conn.commit()
+            self._num_uncommitted = 0
+
+    def report(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0.0
+        mean_parse_seconds = self.parse_seconds / self.misses if self.misses > 0 else 0.0
+        return f"Parse cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), " \
+               f"saved ~{self.hits * mean_parse_seconds:.1f}s of parser time."
+
+    def close(self):
+        with self._lock:
+            for name, value in (("hits", self.hits), ("misses", self.misses), ("parse_seconds", self.parse_seconds)):
+                self._conn.execute("INSERT INTO stats (name, value) VALUES (?, ?) "
+                                   "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, value))
+            total_hits, total_misses = (
+                self._conn.execute("SELECT value FROM stats WHERE name = ?", (name,)).fetchone()[0]
+                for name in ("hits", "misses"))
+            self._conn.commit()
+            self._conn.close()
+        print(self.report())
+        print(f"Parse cache total over all sessions: {int(total_hits)} hits, {int(total_misses)} misses.")
+
+    @staticmethod
+    def open(path: str, parser_id: str, max_entries: int = 1000000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        return ParseCache(path, parser_id, max_entries=max_entries)
+
+
+def _value_starts(parsed_result: Dict[str, str], address: str, normalized_address: str) -> Dict[str, int]:
+    # Start of each value in the address, or -1 if it is not found. The same text may appear more than once with
+    # different widths, e.g. "１-1" and "1-1", so the occurrence whose original text is the value is preferred,
+    # and then the one after the previous value.
+    address = address.strip()
+    starts = {}
+    end = 0
+    for key, value in parsed_result.items():
+        normalized_value = normalize_address(value)
+        occurrences = []
+        index = normalized_address.find(normalized_value) if normalized_value else -1
+        while index >= 0:
+            occurrences.append(index)
+            index = normalized_address.find(normalized_value, index + 1)
+        if not occurrences:
+            starts[key] = -1
+            continue
+        starts[key] = min(occurrences, key=lambda start: (address[start:start + len(normalized_value)] != value,
+                                                          start < end, start))
+        end = starts[key] + len(normalized_value)
+    return starts
+
+
+def _denormalize(parsed_result: Dict[str, List], address: str) -> Dict[str, str]:
+    # Cached values are normalized, so take the substring of this address at the cached position
+    # (normalization keeps the length of the address).
+    address = address.strip()
+    return {key: address[start:start + len(value)] if start >= 0 else value
+            for key, (value, start) in parsed_result.items()}
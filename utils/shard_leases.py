@@ -0,0 +1,127 @@
+import os
+import re
+import socket
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+SHARD_PREFIX = "shard"
+
+
+def shard_name(shard: int) -> str:
+    return f"{SHARD_PREFIX}{shard:05d}"
+
+
+def shard_file_id(input_path: str, shard: int) -> str:
+    # Files of a shard are prefixed with the input name, so that shards of inputs sharing a directory don't collide
+    return f"{os.path.basename(input_path)}.{shard_name(shard)}"
+
+
+_SHARD_FILE_PATTERN = re.compile(rf"(^|\.){SHARD_PREFIX}\d{{5}}_")
+
+
+def is_shard_file(name: str) -> bool:
+    # Including files of shards named without the input
+    return _SHARD_FILE_PATTERN.search(name) is not None
+
+
+class LeaseLostError(Exception):
+    """
+    Raised when the lease of a shard has expired and may have been taken by another annotator.
+    """
+
+
+class ShardLeases:
+    """
+    Leases of disjoint row ranges (shards) of one input, shared by annotator processes through sqlite.
+    A shard is leased to one owner at a time. A lease which is not renewed within lease_seconds expires,
+    so that the shard of a crashed process is taken over by another one.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 600, owner: Optional[str] = None):
+        self._path = path
+        self.lease_seconds = lease_seconds
+        self.owner = owner if owner is not None else f"{socket.gethostname()}:{os.getpid()}"
+        # Transactions are controlled explicitly with BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+
+    def claim(self) -> Optional[Tuple[int, int, int]]:
+        """
+        Lease the first shard which is neither done nor leased to others, and return (shard, start, end).
+        """
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute("SELECT shard, start_row, end_row FROM shards WHERE done = 0 AND "
+                                     "(owner IS NULL OR owner = ? OR expires < ?) ORDER BY shard LIMIT 1",
+                                     (self.owner, now)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE shards SET owner = ?, expires = ? WHERE shard = ?",
+                                   (self.owner, now + self.lease_seconds, row[0]))
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def renew(self, shard: int) -> bool:
+        """
+        Extend the lease. Return False if the lease has been taken by another owner.
+        """
+        now = time.time()
+        cursor = self._conn.execute("UPDATE shards SET expires = ? WHERE shard = ? AND owner = ? AND done = 0",
+                                    (now + self.lease_seconds, shard, self.owner))
+        return cursor.rowcount == 1
+
+    def complete(self, shard: int):
+        self._conn.execute("UPDATE shards SET done = 1, owner = NULL WHERE shard = ? AND owner = ?", (shard, self.owner))
+
+    def release(self, shard: int):
+        # Unfinished shard can be taken by others immediately
+        self._conn.execute("UPDATE shards SET owner = NULL WHERE shard = ? AND owner = ?", (shard, self.owner))
+
+    def shards(self) -> List[Tuple[int, int, int, bool]]:
+        return [(shard, start, end, bool(done)) for shard, start, end, done in
+                self._conn.execute("SELECT shard, start_row, end_row, done FROM shards ORDER BY shard")]
+
+    def report(self) -> str:
+        shards = self.shards()
+        num_done = sum(done for _, _, _, done in shards)
+        return f"{num_done} / {len(shards)} shards are done."
+
+    def close(self):
+        self._conn.close()
+
+    @staticmethod
+    def open(path: str, num_rows: int, shard_size: int, lease_seconds: float = 600,
+             owner: Optional[str] = None) -> "ShardLeases":
+        """
+        Open the lease table, creating shards of shard_size rows if it is new.
+        """
+        assert shard_size > 0, f"Shard size should be positive, but got {shard_size}."
+        leases = ShardLeases(path, lease_seconds=lease_seconds, owner=owner)
+        conn = leases._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, start_row INTEGER, "
+                         "end_row INTEGER, owner TEXT, expires REAL, done INTEGER DEFAULT 0)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+            meta = dict(conn.execute("SELECT name, value FROM meta"))
+            if not meta:
+                conn.executemany("INSERT INTO meta (name, value) VALUES (?, ?)",
+                                 [("num_rows", num_rows), ("shard_size", shard_size)])
+                conn.executemany("INSERT INTO shards (shard, start_row, end_row) VALUES (?, ?, ?)",
+                                 [(i, start, min(start + shard_size, num_rows))
+                                  for i, start in enumerate(range(0, num_rows, shard_size))])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        assert not meta or meta == {"num_rows": num_rows, "shard_size": shard_size}, \
+            f"Shards should be made for the same input!\n  Expected: {meta}\n" \
+            f"  Actual: {{'num_rows': {num_rows}, 'shard_size': {shard_size}}}"
+        return leases
+
+    @staticmethod
+    def path_for(output_dir: str, input_path: str) -> str:
+        return os.path.join(output_dir, os.path.basename(input_path) + ".shards.sqlite")
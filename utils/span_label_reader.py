@@ -0,0 +1,38 @@
+import json
+from typing import Iterator, List, Tuple
+
+from constants import OUTSIDE_LABEL
+from utils.compression import iter_lines
+
+
+def spans_to_labels(length: int, spans: List[Tuple[int, int, str]]) -> List[str]:
+    labels = [OUTSIDE_LABEL] * length
+    for start, end, label in spans:
+        labels[start:end] = [label] * (end - start)
+    return labels
+
+
+class SpanLabelReader:
+    """
+    Streaming reader of the span-based char label file written by SpanLabelWriter.
+    Records are decoded lazily while iterating. The file may be compressed (see utils.compression).
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        lines = iter_lines(path)
+        self.labels = json.loads(next(lines))["labels"]
+        lines.close()
+
+    def iter_spans(self) -> Iterator[Tuple[str, List[Tuple[int, int, str]]]]:
+        lines = iter_lines(self._path)
+        next(lines)
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield record["address"], [(start, end, self.labels[label_id]) for start, end, label_id in record["spans"]]
+
+    def __iter__(self) -> Iterator[Tuple[str, List[str]]]:
+        for address, spans in self.iter_spans():
+            yield address, spans_to_labels(len(address), spans)
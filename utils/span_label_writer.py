@@ -0,0 +1,62 @@
+import json
+from typing import Iterable, List, Optional, Tuple
+
+from constants import CLASSES, ERASED_LABEL, OUTSIDE_LABEL
+from utils.buffered_writer import BufferedFileWriter
+from utils.instrumentation import timed
+from utils.span_label_reader import SpanLabelReader
+
+DEFAULT_LABELS = [OUTSIDE_LABEL, ERASED_LABEL, *CLASSES]
+
+
+def labels_to_spans(labels: List[str]) -> List[Tuple[int, int, str]]:
+    """
+    Convert char-wise labels into (start, end, label) runs. Runs of OUTSIDE_LABEL are omitted.
+    """
+    spans = []
+    start = 0
+    for i in range(1, len(labels) + 1):
+        if i == len(labels) or labels[i] != labels[start]:
+            if labels[start] != OUTSIDE_LABEL:
+                spans.append((start, i, labels[start]))
+            start = i
+    return spans
+
+
+class SpanLabelWriter(BufferedFileWriter):
+    """
+    Writes char-wise labels as JSON lines of spans. The first line is the label vocabulary,
+    and each following line is {"address": str, "spans": [[start, end, label_id], ...]}.
+    When appending to an existing file, the vocabulary in its first line is used.
+    """
+
+    def __init__(self, path: str, labels: Optional[List[str]] = None, append: bool = False, flush_every: int = 1,
+                 flush_interval: Optional[float] = None, fsync: bool = False):
+        super().__init__(path, append=append, flush_every=flush_every, flush_interval=flush_interval, fsync=fsync)
+        has_header = append and self.offset > 0
+        if has_header:
+            file_labels = SpanLabelReader(path).labels
+            if labels is not None and labels != file_labels:
+                self._file.close()
+                raise ValueError(f"Labels {labels} don't match the vocabulary {file_labels} of {path}")
+            labels = file_labels
+        self._labels = labels if labels is not None else DEFAULT_LABELS
+        self._label_to_id = {label: i for i, label in enumerate(self._labels)}
+        if not has_header:
+            self._write(json.dumps({"labels": self._labels}, ensure_ascii=False) + "\n")
+            self.flush()
+
+    @timed("write_char_label")
+    def append(self, address: str, labels: List[str]):
+        assert len(address) == len(labels),\
+            f"Cannot write row whose address length and label length don't match!\n  Address: {address}  Labels: {labels}"
+        self.append_spans(address, labels_to_spans(labels))
+
+    def append_spans(self, address: str, spans: Iterable[Tuple[int, int, str]]):
+        try:
+            encoded_spans = [[start, end, self._label_to_id[label]] for start, end, label in spans]
+        except KeyError as e:
+            raise ValueError(f"Label {e} is not in the vocabulary {self._labels}") from e
+        self._write(json.dumps({"address": address, "spans": encoded_spans}, ensure_ascii=False,
+                               separators=(",", ":")) + "\n")
+        self._end_record()
@@ -0,0 +1,120 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Tuple
+
+from utils.compression import START_CHECKPOINT, Checkpoint, detect_compression, iter_lines_from_checkpoint
+from utils.instrumentation import timed
+
+# Rows between checkpoints of the decompressor state, which take some tens of KB each for gzip
+CHECKPOINT_INTERVAL = 16384
+
+
+class StreamingCSVReader:
+    """
+    Reader of compressed files, which cannot be memory-mapped like LazyCSVReader.
+    Rows are decompressed forward from the current position and the last cache_size rows are kept, so reading
+    rows in order, including prefetching and going back a little, takes bounded memory. Reading any other row
+    decompresses from the last checkpoint before it, which are kept every checkpoint_interval rows or so. Bz2 and
+    xz files have checkpoints only at the starts of streams, so a file compressed as a single stream by other tools
+    is decompressed again from the beginning.
+    """
+
+    def __init__(self, path: str, sep: str, header: List[str], has_header: bool, num_rows: int,
+                 checkpoints: List[Tuple[int, Checkpoint]], cache_size: int = 1024):
+        self._path = path
+        self._compression = detect_compression(path)
+        self._sep = sep
+        self._header = header
+        self._has_header = has_header
+        self._num_rows = num_rows
+        # (index of the row to be read next, checkpoint), starting from the beginning of the file
+        self._checkpoints = [(0, START_CHECKPOINT)] + checkpoints
+        self._checkpoint_rows = [row for row, _ in self._checkpoints]
+        self._cache_size = cache_size
+        self._cache: "OrderedDict[int, Dict[str, str]]" = OrderedDict()
+        self._rows = None
+        self._next_index = 0
+
+    def get_header(self) -> List[str]:
+        return self._header
+
+    @timed("csv_parse")
+    def read_record(self, index: int) -> Dict[str, str]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Record index out of range: {index}")
+        if index not in self._cache:
+            row, checkpoint = self._checkpoints[bisect_right(self._checkpoint_rows, index) - 1]
+            if self._rows is None or index < self._next_index or row > self._next_index:
+                self._seek(row, checkpoint)
+            for i, line in self._rows:
+                self._next_index = i + 1
+                # Rows skipped to reach the index are parsed only if they stay in the cache
+                if i > index - self._cache_size:
+                    self._cache[i] = self._parse(line)
+                    if len(self._cache) > self._cache_size:
+                        self._cache.popitem(last=False)
+                if i == index:
+                    break
+        self._cache.move_to_end(index)
+        # Callers add estimated labels to the record
+        return dict(self._cache[index])
+
+    def _seek(self, row: int, checkpoint: Checkpoint):
+        if self._rows is not None:
+            self._rows.close()
+        self._rows = self._iter_rows(row, checkpoint)
+        self._next_index = row
+
+    def _iter_rows(self, row: int, checkpoint: Checkpoint) -> Iterator[Tuple[int, str]]:
+        lines = _iter_non_blank_lines(iter_lines_from_checkpoint(self._path, self._compression, checkpoint))
+        if self._has_header and checkpoint is START_CHECKPOINT:
+            next(lines, None)
+        yield from enumerate(lines, start=row)
+
+    def _parse(self, line: str) -> Dict[str, str]:
+        values = line.split(self._sep)
+        assert len(self._header) == len(values), \
+            f"Malformed line doesn't match header schema!\nHeader: {self._header}\nLine: {line}"
+        return {label.strip(): token.strip() for label, token in zip(self._header, values)}
+
+    def __len__(self):
+        return self._num_rows
+
+    def close(self):
+        if self._rows is not None:
+            self._rows.close()
+            self._rows = None
+        self._cache.clear()
+
+    @staticmethod
+    def from_file(path: str, sep: str, header=None, cache_size: int = 1024,
+                  checkpoint_interval: int = CHECKPOINT_INTERVAL):
+        has_header = header is None
+        # Rows are counted in one pass without keeping them, taking checkpoints after the header
+        checkpoints = []
+        num_rows = 0
+
+        def on_checkpoint(checkpoint: Checkpoint):
+            if header is not None:
+                checkpoints.append((num_rows, checkpoint))
+
+        lines = _iter_non_blank_lines(iter_lines_from_checkpoint(
+            path, detect_compression(path), checkpoint_interval=checkpoint_interval, on_checkpoint=on_checkpoint))
+        if has_header:
+            first_line = next(lines, None)
+            header = [col for col in first_line.strip().split(sep)] if first_line is not None else []
+        for _ in lines:
+            num_rows += 1
+        checkpoint_rows = [0] + [row for row, _ in checkpoints] + [num_rows]
+        if max(end - start for start, end in zip(checkpoint_rows, checkpoint_rows[1:])) > 8 * checkpoint_interval:
+            print(f"{path} is compressed in long streams, so reading its rows out of order, as for duplicate groups, "
+                  f"shards and queue blocks, decompresses it again from the beginning. Recompress it with gzip "
+                  f"for those modes.")
+        return StreamingCSVReader(path, sep, header, has_header, num_rows, checkpoints, cache_size=cache_size)
+
+
+def _iter_non_blank_lines(lines: Iterator[bytes]) -> Iterator[str]:
+    # Blank lines such as a trailing newline are skipped, as in LazyCSVReader
+    return (line for line in map(bytes.decode, lines) if line.strip())
@@ -0,0 +1,327 @@
+import argparse
+from collections import Counter, deque
+import csv
+from itertools import islice, zip_longest
+import json
+import multiprocessing
+import os
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from constants import CHAR_LABEL_SEPARATOR, CLASSES, ERASED_LABEL, OUTSIDE_LABEL
+from utils.annotation_model import words_from_spans
+from utils.annotation_session import CHAR_LABEL_FILE_NAME, LABELLED_FILE_NAME, SPAN_LABEL_FILE_NAME
+from utils.compression import COMPRESSIONS, open_binary, strip_compression_extension
+from utils.span_label_reader import spans_to_labels
+from utils.span_label_writer import labels_to_spans
+
+# (byte offset, lines) of a record. A labelled row and a span char label record are one line, and a text char
+# label record is an address line and a label line.
+RawRecord = Tuple[int, List[bytes]]
+# (labelled file, char label file, first record number, labelled records, char label records)
+Chunk = Tuple[str, str, int, List[Optional[RawRecord]], List[Optional[RawRecord]]]
+
+
+def find_output_files(output_dir: str) -> List[Tuple[str, str]]:
+    """
+    Return (labelled file, char label file) pairs under the directory, including subdirectories of shards,
+    merged and compacted outputs.
+    """
+    pairs = []
+    for dir_path, _, names in os.walk(output_dir):
+        for name in sorted(names):
+            if strip_compression_extension(name).endswith(LABELLED_FILE_NAME):
+                prefix = strip_compression_extension(name)[:-len(LABELLED_FILE_NAME)]
+                candidates = [prefix + char_label_name + extension
+                              for char_label_name in (CHAR_LABEL_FILE_NAME, SPAN_LABEL_FILE_NAME)
+                              for extension in ("", *COMPRESSIONS)]
+                char_label_name = next((c for c in candidates if os.path.exists(os.path.join(dir_path, c))), None)
+                if char_label_name is None:
+                    print(f"Skipped {os.path.join(dir_path, name)} which has no char label file.")
+                    continue
+                pairs.append((os.path.join(dir_path, name), os.path.join(dir_path, char_label_name)))
+    return pairs
+
+
+def _violation(kind: str, path: str, offset: int, record: int, message: str) -> Dict:
+    return {"kind": kind, "file": path, "offset": offset, "record": record, "message": message}
+
+
+def _iter_lines(path: str, violations: List[Dict]) -> Iterator[Tuple[int, bytes]]:
+    # (byte offset, line). Offsets of compressed files are in the decompressed stream.
+    offset = 0
+    with open_binary(path) as f:
+        try:
+            for line in f:
+                yield offset, line
+                offset += len(line)
+        except EOFError:
+            violations.append(_violation("truncated_file", path, offset, -1, "Compressed stream is cut in the middle"))
+
+
+def _iter_line_records(path: str, violations: List[Dict]) -> Iterator[RawRecord]:
+    # Labelled rows and span records, after the header line
+    lines = _iter_lines(path, violations)
+    next(lines, None)
+    for offset, line in lines:
+        # Trailing blank lines
+        if line.strip():
+            yield offset, [line]
+
+
+def _iter_text_records(path: str, violations: List[Dict]) -> Iterator[RawRecord]:
+    # Records of the text char label file are an address line, a label line, which is empty for an address of one
+    # erased char, and a blank line. After a record breaking this layout, records are found again from the next
+    # blank line, so that a missing or extra line breaks only its own record.
+    lines = _iter_lines(path, violations)
+    record: List[Tuple[int, bytes]] = []
+    for offset, line in lines:
+        if not record and not line.strip():
+            # Trailing blank lines
+            continue
+        record.append((offset, line))
+        if len(record) < 3:
+            continue
+        if not record[2][1].strip():
+            yield record[0][0], [line for _, line in record[:2]]
+            record = []
+        elif not record[1][1].strip():
+            # The line before the blank line is alone, and the next record starts after it
+            yield record[0][0], [record[0][1]]
+            record = record[2:]
+        else:
+            for offset, line in lines:
+                if not line.strip():
+                    break
+                record.append((offset, line))
+            # Two records without the blank line between them are still checked one by one
+            if len(record) % 2 == 0:
+                violations.append(_violation("malformed_record", path, record[2][0], -1,
+                                             f"Blank line is missing between {len(record) // 2} records"))
+                for i in range(0, len(record), 2):
+                    yield record[i][0], [line for _, line in record[i:i + 2]]
+            else:
+                yield record[0][0], [line for _, line in record]
+            record = []
+    if record:
+        yield record[0][0], [line for _, line in record]
+
+
+def _read_header(path: str) -> bytes:
+    with open_binary(path) as f:
+        return f.readline()
+
+
+def _read_headers(labelled_path: str, char_label_path: str) \
+        -> Tuple[Optional[List[str]], Optional[List[str]], Optional[Dict]]:
+    """
+    Return the header of the labelled file, the label vocabulary of the span file if it is, and a violation if
+    either of them is broken.
+    """
+    path = labelled_path
+    try:
+        header = next(csv.reader([_read_header(labelled_path).decode("utf-8")], delimiter="\t"), [])
+        if not header:
+            return None, None, _violation("malformed_header", path, 0, -1, "Header is empty")
+        if not strip_compression_extension(char_label_path).endswith(SPAN_LABEL_FILE_NAME):
+            return header, None, None
+        path = char_label_path
+        labels = json.loads(_read_header(char_label_path))["labels"]
+    except (OSError, EOFError, ValueError, KeyError, TypeError) as e:
+        return None, None, _violation("malformed_header", path, 0, -1, f"Header cannot be read: {e!r}")
+    if not isinstance(labels, list) or not all(isinstance(label, str) for label in labels):
+        return None, None, _violation("malformed_header", path, 0, -1, f"Labels should be strings: {labels!r}")
+    return header, labels, None
+
+
+def iter_chunks(pairs: List[Tuple[str, str]], chunk_size: int, violations: List[Dict]) -> Iterator[Chunk]:
+    """
+    Read records of both files of each pair side by side, and yield them in chunks of chunk_size records.
+    A record missing in one of the files is None.
+    """
+    for labelled_path, char_label_path in pairs:
+        is_span = strip_compression_extension(char_label_path).endswith(SPAN_LABEL_FILE_NAME)
+        records = zip_longest(_iter_line_records(labelled_path, violations),
+                              _iter_line_records(char_label_path, violations) if is_span
+                              else _iter_text_records(char_label_path, violations))
+        first_record = 0
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            yield labelled_path, char_label_path, first_record, [r for r, _ in chunk], [r for _, r in chunk]
+            first_record += len(chunk)
+
+
+def _parse_text_record(lines: List[bytes]) -> Tuple[str, List[str], Optional[str]]:
+    # (address, char labels, error)
+    if len(lines) != 2:
+        return "", [], f"Record should be an address line and a label line, but has {len(lines)} lines"
+    try:
+        address, labels = lines[0].decode("utf-8").strip(), lines[1].decode("utf-8").strip()
+    except UnicodeDecodeError as e:
+        return "", [], f"Invalid UTF-8: {e}"
+    return address, labels.split(CHAR_LABEL_SEPARATOR), None
+
+
+def _parse_span_record(line: bytes, labels: List[str]) -> Tuple[str, List[str], Optional[str]]:
+    try:
+        record = json.loads(line)
+        address, spans = record["address"], record["spans"]
+    except (ValueError, KeyError, TypeError) as e:
+        # UnicodeDecodeError is a ValueError
+        return "", [], f"Malformed JSON record: {e!r}"
+    if not isinstance(address, str) or not isinstance(spans, list):
+        return "", [], "Record should have an address string and a list of spans"
+    for span in spans:
+        if not isinstance(span, list) or len(span) != 3 \
+                or not all(isinstance(v, int) and not isinstance(v, bool) for v in span):
+            return "", [], f"Span {span!r} should be [start, end, label id] of integers"
+        if not 0 <= span[0] < span[1] <= len(address) or not 0 <= span[2] < len(labels):
+            return "", [], f"Span {span} is out of the address or the label vocabulary"
+    return address, spans_to_labels(len(address), [(start, end, labels[i]) for start, end, i in spans]), None
+
+
+def validate_chunk(chunk: Chunk, header: List[str], span_labels: Optional[List[str]]) -> Tuple[int, List[Dict]]:
+    """
+    Check records of a chunk and return the number of records and the violations found.
+    """
+    labelled_path, char_label_path, first_record, labelled_records, char_label_records = chunk
+    vocabulary = {OUTSIDE_LABEL, ERASED_LABEL, *CLASSES}
+    violations = []
+    for i, (labelled_record, char_label_record) in enumerate(zip(labelled_records, char_label_records)):
+        record = first_record + i
+        if labelled_record is None:
+            violations.append(_violation("missing_record", char_label_path, char_label_record[0], record,
+                                         f"Record is missing in {labelled_path}"))
+            continue
+        if char_label_record is None:
+            violations.append(_violation("missing_record", labelled_path, labelled_record[0], record,
+                                         f"Record is missing in {char_label_path}"))
+            continue
+        labelled_offset, (line,) = labelled_record
+        char_label_offset, char_label_lines = char_label_record
+
+        values = next(csv.reader([line.decode("utf-8", "replace")], delimiter="\t"), [])
+        row = dict(zip(header, values)) if len(values) == len(header) else None
+        if row is None:
+            violations.append(_violation("malformed_row", labelled_path, labelled_offset, record,
+                                         f"Row has {len(values)} columns while header has {len(header)}"))
+        if span_labels is not None:
+            address, char_labels, error = _parse_span_record(char_label_lines[0], span_labels)
+        else:
+            address, char_labels, error = _parse_text_record(char_label_lines)
+        if error is not None:
+            violations.append(_violation("malformed_record", char_label_path, char_label_offset, record, error))
+            continue
+
+        if len(address) != len(char_labels):
+            violations.append(_violation("length_mismatch", char_label_path, char_label_offset, record,
+                                         f"Address has {len(address)} chars but {len(char_labels)} labels"))
+            continue
+        unknown_labels = set(char_labels) - vocabulary
+        if unknown_labels:
+            violations.append(_violation("unknown_label", char_label_path, char_label_offset, record,
+                                         f"Labels {sorted(unknown_labels)} are not in the class vocabulary"))
+        if row is None:
+            continue
+        if row.get("address") != address:
+            violations.append(_violation("address_mismatch", labelled_path, labelled_offset, record,
+                                         f"Address {row.get('address')!r} differs from {address!r} in "
+                                         f"{char_label_path} at offset {char_label_offset}"))
+            continue
+        words = words_from_spans(address, labels_to_spans(char_labels), CLASSES)
+        wrong_classes = [label for label in CLASSES if label in row and row[label] != words[label]]
+        if wrong_classes:
+            violations.append(_violation("segment_mismatch", labelled_path, labelled_offset, record,
+                                         "; ".join(f"{label}: {row[label]!r} != {words[label]!r}"
+                                                   for label in wrong_classes)))
+    return len(labelled_records), violations
+
+
+def validate(pairs: List[Tuple[str, str]], num_workers: int, chunk_size: int = 10000) \
+        -> Iterator[Tuple[int, List[Dict]]]:
+    """
+    Check pairs of labelled file and char label file in chunks of records in parallel, and yield the number of
+    records and the violations of each chunk in order.
+    """
+    headers, span_labels = {}, {}
+    valid_pairs, header_violations = [], []
+    for labelled_path, char_label_path in pairs:
+        header, labels, violation = _read_headers(labelled_path, char_label_path)
+        if violation is not None:
+            # Records cannot be checked without the header
+            header_violations.append(violation)
+            continue
+        headers[labelled_path], span_labels[char_label_path] = header, labels
+        valid_pairs.append((labelled_path, char_label_path))
+    yield 0, header_violations
+    # Violations found while reading, such as a cut compressed stream
+    read_violations = []
+    chunks = iter_chunks(valid_pairs, chunk_size, read_violations)
+
+    def args_of(chunk: Chunk):
+        return chunk, headers[chunk[0]], span_labels.get(chunk[1])
+
+    if num_workers == 0:
+        for chunk in chunks:
+            yield validate_chunk(*args_of(chunk))
+    else:
+        with multiprocessing.Pool(num_workers) as pool:
+            # Chunks are read only as fast as they are checked
+            pending = deque()
+            for chunk in chunks:
+                if len(pending) >= 2 * num_workers:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(validate_chunk, args_of(chunk)))
+            while pending:
+                yield pending.popleft().get()
+    yield 0, read_violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that labelled files and char label files of an output "
+                                                 "directory are consistent, and report every violation with its "
+                                                 "byte offset.")
+    parser.add_argument("-d", "--output_dir", type=str, help="Directory to check all outputs in, recursively")
+    parser.add_argument("--labelled_file", type=str, help="Check only this labelled file...")
+    parser.add_argument("--char_label_file", type=str, help="...and this char label file (text or span format)")
+    parser.add_argument("--num_workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of checking processes. 0 to check in this process.")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="Number of records checked at a time")
+    parser.add_argument("-o", "--output_file", type=str, help="Write violations as JSON lines")
+    parser.add_argument("--max_printed", type=int, default=20, help="Number of violations printed")
+    args = parser.parse_args(sys.argv[1:])
+    assert (args.output_dir is None) != (args.labelled_file is None or args.char_label_file is None), \
+        "Give either --output_dir, or both --labelled_file and --char_label_file."
+
+    pairs = find_output_files(args.output_dir) if args.output_dir is not None \
+        else [(args.labelled_file, args.char_label_file)]
+    start = time.perf_counter()
+    num_records = 0
+    kinds = Counter()
+    output_file = open(args.output_file, "w") if args.output_file is not None else None
+    try:
+        for records, violations in validate(pairs, args.num_workers, chunk_size=args.chunk_size):
+            num_records += records
+            for violation in violations:
+                if sum(kinds.values()) < args.max_printed:
+                    print(f"{violation['file']}:{violation['offset']} (record {violation['record']}) "
+                          f"{violation['kind']}: {violation['message']}")
+                kinds[violation["kind"]] += 1
+                if output_file is not None:
+                    output_file.write(json.dumps(violation, ensure_ascii=False) + "\n")
+    finally:
+        if output_file is not None:
+            output_file.close()
+    seconds = time.perf_counter() - start
+    print(f"Checked {num_records} records of {len(pairs)} file pairs in {seconds:.1f}s "
+          f"({num_records / seconds if seconds else 0:.0f} records/s). "
+          f"{sum(kinds.values())} violations: {dict(kinds) or 'none'}")
+    if kinds:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()